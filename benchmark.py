@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Benchmarks of osmapis parsing on real OSM XML extracts.
+
+Usage: python benchmark.py [-r REPEAT] [-p PROCESSES] FILE.osm [FILE.osm ...]
+
+Reports the best time per element of the measured operations, the document
+level operations are measured with each available parser backend and on
+Overpass JSON output created from the same data.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os.path
+import shutil
+import tempfile
+import timeit
+import zlib
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.x compatibility
+    tracemalloc = None
+
+import osmapis
+
+
+def per_element(label, func, count, repeat):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print("    {:<28} {:8.2f} us/element".format(label, best / max(count, 1) * 1e6))
+
+
+def retained(label, func):
+    if tracemalloc is None:
+        return
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    print("    {:<28} {:8.1f} MB retained".format(label, size / 1e6))
+
+
+def overpass_json(osm):
+    """ Return Overpass JSON output with all elements of OSM wrapper. """
+    items = []
+    for element in osm:
+        item = {"type": element.xml_tag}
+        item.update(element.attribs)
+        if element.xml_tag == "way":
+            item["nodes"] = list(element.nds)
+        elif element.xml_tag == "relation":
+            item["members"] = [dict(member) for member in element.members]
+        if len(element.tags) > 0:
+            item["tags"] = dict(element.tags)
+        items.append(item)
+    return json.dumps({"version": 0.6, "elements": items}, indent=1).encode("utf-8")
+
+
+def bench_file(filename, repeat, processes):
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    root = osmapis.ET.XML(data)
+    elements = [(osmapis.wrappers[child.tag], child) for child in root if child.tag in ("node", "way", "relation")]
+    print("{} ({} elements, {:.1f} MB)".format(filename, len(elements), len(data) / 1e6))
+
+    def parse_attribs():
+        for cls, element in elements:
+            cls.parse_attribs(element)
+
+    def from_elements():
+        for cls, element in elements:
+            cls.from_xml(element)
+
+    def from_elements_lazy():
+        for cls, element in elements:
+            cls.from_xml(element, lazy=True)
+
+    per_element("parse_attribs", parse_attribs, len(elements), repeat)
+    per_element("wrapper from_xml", from_elements, len(elements), repeat)
+    per_element("wrapper from_xml lazy", from_elements_lazy, len(elements), repeat)
+    retained("OSM.from_xml", lambda: osmapis.OSM.from_xml(data))
+    retained("OSM.from_xml lazy", lambda: osmapis.OSM.from_xml(data, lazy=True))
+    default = osmapis.parser
+    try:
+        for name in sorted(osmapis.parsers):
+            osmapis.parser = osmapis.parsers[name]()
+            print("  parser {}".format(name))
+            per_element("OSM.from_xml", lambda: osmapis.OSM.from_xml(data), len(elements), repeat)
+            per_element("OSM.from_xml lazy", lambda: osmapis.OSM.from_xml(data, lazy=True), len(elements), repeat)
+            per_element("OSM.iterparse", lambda: sum(1 for _ in osmapis.OSM.iterparse(filename)), len(elements), repeat)
+    finally:
+        osmapis.parser = default
+    osm = osmapis.OSM.from_xml(data)
+    json_data = overpass_json(osm)
+    print("  overpass json ({:.1f} MB, gzipped {:.1f} MB against {:.1f} MB of xml)".format(
+        len(json_data) / 1e6, len(zlib.compress(json_data)) / 1e6, len(zlib.compress(data)) / 1e6))
+    per_element("OSM.from_json", lambda: osmapis.OSM.from_json(json_data), len(elements), repeat)
+    print("  parallel")
+    per_element("OSM.load", lambda: osmapis.OSM.load(filename), len(elements), repeat)
+    per_element("OSM.load processes={}".format(processes),
+                lambda: osmapis.OSM.load(filename, processes=processes), len(elements), repeat)
+    directory = tempfile.mkdtemp()
+
+    def store_load(processes=None):
+        with osmapis.OSMStore(os.path.join(directory, "store"), "n") as store:
+            store.load(filename, processes=processes)
+
+    try:
+        per_element("OSMStore.load", store_load, len(elements), repeat)
+        per_element("OSMStore.load processes={}".format(processes),
+                    lambda: store_load(processes), len(elements), repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark osmapis parsing.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of repetitions, the best is reported")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes of parallel loading")
+    parser.add_argument("files", nargs="+", metavar="FILE.osm")
+    args = parser.parse_args()
+    for filename in args.files:
+        bench_file(filename, args.repeat, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,36 @@ Overpass API.
 
 Variables:
     wrappers        --- Dictionary containing the classes to use for OSM element wrappers.
+    parsers         --- Dictionary of available XML parser backends.
+    parser          --- XML parser backend used for strings and files.
 
 Classes:
     OverpassAPI     --- OSM Overpass API interface.
+    OverpassQuery   --- Builder of canonical Overpass queries.
+    OverpassCache   --- Cache of Overpass results by query hash.
     API             --- OSM API interface.
+    ChangesetManager --- Thread-safe manager of automagically created changesets.
+    BatchSession    --- Write-behind session queueing writes into diff uploads.
     HTTPClient      --- Interface for accessing data over HTTP.
+    HTTPTransport   --- Transport sending requests over a new HTTP connection.
+    RecordedResponse --- HTTP response recorded in memory.
+    RecordingTransport --- Transport recording all exchanges into cassette file.
+    ReplayTransport --- Transport replaying exchanges from cassette file.
+    RequestInfo     --- Metrics of one HTTP request.
+    RequestStats    --- Aggregator of HTTP request metrics per endpoint.
     Node            --- Node wrapper.
     Way             --- Way wrapper.
     Relation        --- Relation wrapper.
     Changeset       --- Changeset wrapper.
     OSM             --- OSM XML document wrapper.
     OSC             --- OSC XML document wrapper.
+    OSMStore        --- Persistent store of OSM elements.
+    ElementTreeParser --- Parser backend using xml.etree.ElementTree.
+    LxmlParser      --- Parser backend using lxml.
+    ExpatParser     --- Parser backend building wrappers from expat callbacks.
+    InternTable     --- Bounded table deduplicating parsed strings.
+    ReplicationFollower --- Follower of replication diffs in local directory.
+    StandInServer   --- Local HTTP server emulating OSM API and Overpass API.
     APIError        --- OSM API exception.
 
 """
@@ -27,34 +46,92 @@ __license__ = "LGPL 3.0"
 __version__ = "0.9.3"
 
 from abc import ABCMeta, abstractmethod
-from base64 import b64encode
-from collections import MutableSet, MutableMapping
-from itertools import chain
+from array import array
+from base64 import b64decode, b64encode
+import codecs
+import copy
+try:
+    from collections.abc import MutableSet, MutableMapping
+except ImportError:
+    from collections import MutableSet, MutableMapping
+from collections import OrderedDict
+import gzip
+import hashlib
+import inspect
+import io
+from itertools import chain, groupby
+import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 import os
 import os.path
-from time import sleep
-import xml.etree.cElementTree as ET
+import pickle
+import random
+import re
+import shelve
+import socket
+import threading
+from time import sleep, time
+import zlib
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from xml.parsers import expat
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+try:
+    from http.client import HTTPConnection, HTTPException
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
 try:
-    from http.client import HTTPConnection
+    from urllib.parse import parse_qs, urlencode, urljoin, urlsplit, urlunsplit
 except ImportError:
-    from httplib import HTTPConnection
+    from urllib import urlencode
+    from urlparse import parse_qs, urljoin, urlsplit, urlunsplit
 try:
-    from urllib.parse import unquote, urlencode
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 except ImportError:
-    from urllib import unquote, urlencode
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
 
 
 __all__ = ["wrappers",
            "OverpassAPI",
+           "OverpassQuery",
+           "OverpassCache",
            "API",
+           "ChangesetManager",
+           "BatchSession",
            "HTTPClient",
+           "HTTPTransport",
+           "RecordedResponse",
+           "RecordingTransport",
+           "ReplayTransport",
+           "RequestInfo",
+           "RequestStats",
            "Node",
            "Way",
            "Relation",
            "Changeset",
            "OSM",
            "OSC",
+           "OSMStore",
+           "ElementTreeParser",
+           "LxmlParser",
+           "ExpatParser",
+           "parsers",
+           "parser",
+           "InternTable",
+           "ReplicationFollower",
+           "StandInServer",
            "APIError"]
 
 
@@ -72,15 +149,527 @@ def abstractclass(cls):
 ### HTTPClient class.                                    ###
 ############################################################
 
+class _TimedHTTPConnection(HTTPConnection):
+    """ HTTPConnection measuring time of DNS lookup and connection setup. """
+
+    dns_time = None
+    connect_time = None
+
+    def connect(self):
+        start = time()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        self.dns_time = time() - start
+        start = time()
+        error = None
+        for family, socktype, proto, canonname, address in addresses:
+            try:
+                self.sock = socket.create_connection(address[:2], self.timeout, self.source_address)
+                break
+            except socket.error as e:
+                error = e
+        else:
+            raise error
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_time = time() - start
+        if getattr(self, "_tunnel_host", None):
+            self._tunnel()
+
+
+class HTTPTransport(object):
+    """
+    Transport sending requests over HTTP connections.
+
+    Persistent connections are kept per thread and server and reused by
+    subsequent requests, unless keepalive is disabled.
+
+    Transports are pluggable into HTTPClient.transport. Any object
+    implementing the request method can be used.
+
+    Attributes:
+        keepalive   --- Should we reuse connections?
+
+    Methods:
+        request     --- Send HTTP request and return response.
+        close       --- Close idle connections of the current thread.
+
+    """
+
+    def __init__(self, keepalive=True):
+        """
+        Keyworded arguments:
+            keepalive   --- Should we reuse connections?
+
+        """
+        self.keepalive = bool(keepalive)
+        self._local = threading.local()
+
+    def request(self, server, method, path, body, headers, info):
+        """
+        Send HTTP request and return response.
+
+        A request failing on reused persistent connection is resent on a new
+        one, unless it's not GET/HEAD request that was already sent whole.
+
+        The response must provide status, reason, getheader(name, default=None),
+        getheaders(), read(amt=None) and close().
+
+        Arguments:
+            server      --- Domain name of HTTP server.
+            method      --- HTTP request method.
+            path        --- Path on server.
+            body        --- Bytes to send or None.
+            headers     --- Dictionary of HTTP headers.
+            info        --- RequestInfo instance to fill with connection timings.
+
+        """
+        connection = self._idle().pop(server, None)
+        if connection is not None:
+            info.dns = info.connect = 0.0
+            start = time()
+            sent = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                return self._receive(server, connection, start, info)
+            except (socket.error, HTTPException):
+                # Server closed the persistent connection meanwhile. Resend
+                # the request only if the server cannot have processed it.
+                connection.close()
+                if sent and method not in ("GET", "HEAD"):
+                    raise
+        connection = _TimedHTTPConnection(server)
+        connection.connect()
+        info.dns = connection.dns_time
+        info.connect = connection.connect_time
+        start = time()
+        connection.request(method, path, body, headers)
+        return self._receive(server, connection, start, info)
+
+    def close(self):
+        """ Close idle connections of the current thread. """
+        idle = self._idle()
+        for connection in idle.values():
+            connection.close()
+        idle.clear()
+
+    def _idle(self):
+        if not hasattr(self._local, "idle"):
+            self._local.idle = {}
+        return self._local.idle
+
+    def _receive(self, server, connection, start, info):
+        response = connection.getresponse()
+        info.ttfb = time() - start
+        return _PooledResponse(self, server, connection, response)
+
+    def _release(self, server, connection, reusable):
+        if self.keepalive and reusable:
+            previous = self._idle().get(server)
+            if previous is not None and previous is not connection:
+                previous.close()
+            self._idle()[server] = connection
+        else:
+            connection.close()
+
+
+class _PooledResponse(object):
+    """ HTTP response returning its connection to HTTPTransport on close. """
+
+    def __init__(self, transport, server, connection, response):
+        self._transport = transport
+        self._server = server
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._connection is None:
+            return
+        reusable = not self._response.will_close and self._response.isclosed()
+        self._response.close()
+        self._transport._release(self._server, self._connection, reusable)
+        self._connection = None
+
+
+class RecordedResponse(object):
+    """
+    HTTP response recorded in memory.
+
+    Attributes:
+        status      --- HTTP status code.
+        reason      --- HTTP reason phrase.
+        headers     --- List of (name, value) tuples.
+        body        --- Raw (possibly compressed) body as bytes.
+
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = list(headers)
+        self.body = body
+        self._position = 0
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.body) - self._position
+        data = self.body[self._position:self._position+amt]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._position = len(self.body)
+
+
+class RecordingTransport(object):
+    """
+    Transport recording all exchanges of other transport into cassette file.
+
+    Request headers are not recorded, so the cassette contains no credentials.
+
+    Usage:
+        with RecordingTransport("api.json") as HTTPClient.transport:
+            ...
+
+    Attributes:
+        filename    --- Filename of the cassette.
+        transport   --- Transport used for the real requests.
+        exchanges   --- List of recorded exchanges.
+
+    Methods:
+        request     --- Send HTTP request via transport and record it.
+        save        --- Save the cassette.
+
+    """
+
+    def __init__(self, filename, transport=None):
+        """
+        Arguments:
+            filename    --- Filename of the cassette.
+
+        Keyworded arguments:
+            transport   --- Transport used for the real requests, HTTPTransport by default.
+
+        """
+        self.filename = filename
+        self.transport = transport or HTTPTransport()
+        self.exchanges = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+
+    def request(self, server, method, path, body, headers, info):
+        """
+        Send HTTP request via transport and record it.
+
+        Arguments:
+            server      --- Domain name of HTTP server.
+            method      --- HTTP request method.
+            path        --- Path on server.
+            body        --- Bytes to send or None.
+            headers     --- Dictionary of HTTP headers.
+            info        --- RequestInfo instance to fill with connection timings.
+
+        """
+        response = self.transport.request(server, method, path, body, headers, info)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        recorded = RecordedResponse(response.status, response.reason, response.getheaders(), data)
+        exchange = {"server": server,
+                    "method": method,
+                    "path": path,
+                    "body": _cassette_hash(body),
+                    "status": recorded.status,
+                    "reason": recorded.reason,
+                    "headers": recorded.headers,
+                    "response": b64encode(data).decode("ascii")}
+        with self._lock:
+            self.exchanges.append(exchange)
+        return recorded
+
+    def save(self):
+        """ Save the cassette. """
+        with self._lock:
+            data = {"version": 1, "exchanges": self.exchanges}
+            with open(self.filename, "w") as fp:
+                json.dump(data, fp, indent=1, sort_keys=True)
+
+
+class ReplayTransport(object):
+    """
+    Transport replaying exchanges from cassette file.
+
+    Requests are matched by server, method, path and body. Repeated requests
+    replay the recorded responses in order, the last one is reused when
+    there are no more of them.
+
+    Attributes:
+        filename    --- Filename of the cassette.
+
+    Methods:
+        request     --- Return recorded response for the request.
+
+    """
+
+    def __init__(self, filename):
+        """
+        Arguments:
+            filename    --- Filename of the cassette.
+
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._exchanges = {}
+        with open(filename, "r") as fp:
+            data = json.load(fp)
+        for exchange in data["exchanges"]:
+            key = (exchange["server"], exchange["method"], exchange["path"], exchange["body"])
+            self._exchanges.setdefault(key, []).append(exchange)
+
+    def request(self, server, method, path, body, headers, info):
+        """
+        Return recorded response for the request.
+
+        Raise APIError if there's no recorded exchange matching the request.
+
+        Arguments:
+            server      --- Domain name of HTTP server.
+            method      --- HTTP request method.
+            path        --- Path on server.
+            body        --- Bytes to send or None.
+            headers     --- Dictionary of HTTP headers.
+            info        --- RequestInfo instance to fill with connection timings.
+
+        """
+        key = (server, method, path, _cassette_hash(body))
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                raise APIError("No recorded exchange for {} {}{}".format(method, server, path), body)
+            exchange = exchanges[0]
+            if len(exchanges) > 1:
+                exchanges.pop(0)
+        info.dns = info.connect = info.ttfb = 0.0
+        headers = [tuple(header) for header in exchange["headers"]]
+        return RecordedResponse(exchange["status"], exchange["reason"], headers, b64decode(exchange["response"]))
+
+
+def _cassette_hash(body):
+    """ Return hash identifying request body in cassette. """
+    if body is None:
+        return None
+    return hashlib.sha1(body).hexdigest()
+
+
+class RequestInfo(object):
+    """
+    Metrics of one HTTP request, including its redirects and retries.
+
+    Times are in seconds, dns, connect and ttfb refer to the last attempt,
+    total covers the whole request until the body is consumed.
+
+    Attributes:
+        server      --- Domain name of HTTP server.
+        path        --- Path on server.
+        method      --- HTTP request method.
+        status      --- HTTP status of the last response.
+        bytes_in    --- Number of bytes received (as transferred, i.e. compressed).
+        bytes_out   --- Number of bytes sent.
+        dns         --- Time of DNS lookup.
+        connect     --- Time of connection setup.
+        ttfb        --- Time from sending the request to receiving response headers.
+        total       --- Total time of the request.
+        retries     --- Number of re-attempts on error.
+        redirects   --- Number of followed redirects.
+        error       --- APIError raised by the request or None.
+
+    """
+
+    def __init__(self, server, path, method):
+        self.server = server
+        self.path = path
+        self.method = method
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dns = None
+        self.connect = None
+        self.ttfb = None
+        self.total = None
+        self.retries = 0
+        self.redirects = 0
+        self.error = None
+
+    def __repr__(self):
+        return "<RequestInfo {} {}{} {} {:.3f}s>".format(self.method, self.server, self.path, self.status, self.total or 0)
+
+
+class RequestStats(object):
+    """
+    Aggregator of HTTP request metrics per endpoint, usable as HTTPClient observer.
+
+    Usage:
+        stats = RequestStats()
+        HTTPClient.add_observer(stats)
+
+    Class methods:
+        endpoint    --- Return endpoint name of the path.
+
+    Methods:
+        __call__    --- Record RequestInfo.
+        endpoints   --- Return sorted list of recorded endpoints.
+        percentile  --- Return percentile of recorded metric for endpoint.
+        summary     --- Return dictionary with aggregated metrics per endpoint.
+        reset       --- Forget all recorded data.
+
+    """
+
+    fields = ("dns", "connect", "ttfb", "total", "bytes_in", "bytes_out")
+
+    @classmethod
+    def endpoint(cls, path):
+        """
+        Return endpoint name of the path, e.g. 'map', 'nodes', 'changeset/upload', 'interpreter'.
+
+        Arguments:
+            path        --- Path on server.
+
+        """
+        path = path.split("?", 1)[0]
+        parts = [part for part in path.split("/") if part]
+        if "api" in parts:
+            parts = parts[parts.index("api")+1:]
+        if len(parts) > 0 and parts[0] == str(API.version):
+            parts = parts[1:]
+        return "/".join(part for part in parts if not part.isdigit())
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, info):
+        """
+        Record RequestInfo.
+
+        Arguments:
+            info        --- RequestInfo instance.
+
+        """
+        endpoint = self.endpoint(info.path)
+        with self._lock:
+            data = self._data.setdefault(endpoint, {"count": 0, "errors": 0, "retries": 0, "redirects": 0, "samples": dict((field, []) for field in self.fields)})
+            data["count"] += 1
+            data["retries"] += info.retries
+            data["redirects"] += info.redirects
+            if info.error is not None:
+                data["errors"] += 1
+            for field in self.fields:
+                value = getattr(info, field)
+                if value is not None:
+                    data["samples"][field].append(value)
+
+    def endpoints(self):
+        """ Return sorted list of recorded endpoints. """
+        with self._lock:
+            return sorted(self._data.keys())
+
+    def percentile(self, endpoint, percent, field="total"):
+        """
+        Return percentile of recorded metric for endpoint or None.
+
+        Arguments:
+            endpoint    --- Endpoint name.
+            percent     --- Percentile in range 0-100.
+
+        Keyworded arguments:
+            field       --- One of dns, connect, ttfb, total, bytes_in, bytes_out.
+
+        """
+        with self._lock:
+            if endpoint not in self._data:
+                return None
+            samples = sorted(self._data[endpoint]["samples"][field])
+        if len(samples) == 0:
+            return None
+        position = (len(samples) - 1) * percent / 100.0
+        lower = int(position)
+        upper = min(lower + 1, len(samples) - 1)
+        return samples[lower] + (samples[upper] - samples[lower]) * (position - lower)
+
+    def summary(self, percents=(50, 90, 99)):
+        """
+        Return dictionary with aggregated metrics per endpoint.
+
+        {endpoint: {"count": ..., "errors": ..., "retries": ..., "redirects": ...,
+                    "bytes_in": sum, "bytes_out": sum, "time": sum,
+                    "total": {percent: value}, "ttfb": {percent: value}}}
+
+        Keyworded arguments:
+            percents    --- Percentiles to compute for total and ttfb times.
+
+        """
+        result = {}
+        for endpoint in self.endpoints():
+            with self._lock:
+                data = self._data[endpoint]
+                item = dict((key, data[key]) for key in ("count", "errors", "retries", "redirects"))
+                item["bytes_in"] = sum(data["samples"]["bytes_in"])
+                item["bytes_out"] = sum(data["samples"]["bytes_out"])
+                item["time"] = sum(data["samples"]["total"])
+            for field in ("total", "ttfb"):
+                item[field] = dict((percent, self.percentile(endpoint, percent, field)) for percent in percents)
+            result[endpoint] = item
+        return result
+
+    def reset(self):
+        """ Forget all recorded data. """
+        with self._lock:
+            self._data = {}
+
 class HTTPClient(object):
     """
     Interface for accessing data over HTTP.
 
     Class attributes:
         headers     --- Default headers for HTTP request.
+        chunk_size  --- Size of chunks read from the response body.
+        compress_level --- Compression level used for gzipped payloads.
+        observers   --- List of callables notified with RequestInfo after every request.
+        transport   --- Transport used to send requests (HTTPTransport, RecordingTransport, ReplayTransport).
+        retry_wait  --- Number of seconds to wait before re-attempt on error.
+        max_redirects --- Maximum number of followed redirects per request.
+        permanent_redirects --- Cache of permanent redirects {(server, path): (server, path)},
+                        path None means the whole server.
 
     Class methods:
         request     --- Perform HTTP request and handle possible redirection, on error retry.
+        request_xml --- Perform HTTP request and incrementally parse the body into ET.Element.
+        stream      --- Perform HTTP request and yield decoded chunks of the body.
+        add_observer --- Register observer called with RequestInfo after every request.
+        remove_observer --- Unregister previously added observer.
 
     """
 
@@ -89,10 +678,18 @@ class HTTPClient(object):
 
     headers = {}
     headers["User-agent"] = "osmapis/{0}".format(__version__)
+    headers["Accept-Encoding"] = "gzip, deflate"
+    chunk_size = 64 * 1024
+    compress_level = 6
+    observers = []
+    transport = HTTPTransport()
+    retry_wait = 30
+    max_redirects = 10
+    permanent_redirects = {}
     log = logging.getLogger("osmapis.http")
 
     @classmethod
-    def request(cls, server, path, method="GET", headers={}, payload=None, retry=10):
+    def request(cls, server, path, method="GET", headers={}, payload=None, retry=10, compress=False):
         """
         Perform HTTP request and handle possible redirection, on error retry.
 
@@ -108,58 +705,242 @@ class HTTPClient(object):
             headers     --- Additional HTTP headers.
             payload     --- Dictionary containing data to send with request.
             retry       --- Number of re-attempts on error.
+            compress    --- Send the payload gzipped.
+
+        """
+        return b"".join(cls.stream(server, path, method=method, headers=headers, payload=payload, retry=retry, compress=compress))
+
+    @classmethod
+    def request_xml(cls, server, path, method="GET", headers={}, payload=None, retry=10, compress=False):
+        """
+        Perform HTTP request and incrementally parse the body into ET.Element.
+
+        The body is fed to the parser chunk by chunk as it is downloaded and
+        decompressed, so the whole document is never held as a string.
+
+        Arguments:
+            server      --- Domain name of HTTP server.
+            path        --- Path on server.
+
+        Keyworded arguments:
+            method      --- HTTP request method.
+            headers     --- Additional HTTP headers.
+            payload     --- Dictionary containing data to send with request.
+            retry       --- Number of re-attempts on error.
+            compress    --- Send the payload gzipped.
+
+        """
+        parser = ET.XMLParser()
+        for chunk in cls.stream(server, path, method=method, headers=headers, payload=payload, retry=retry, compress=compress):
+            parser.feed(chunk)
+        return parser.close()
+
+    @classmethod
+    def stream(cls, server, path, method="GET", headers={}, payload=None, retry=10, compress=False):
+        """
+        Perform HTTP request and yield decoded chunks of the body.
+
+        Handles possible redirection and retries on error, see request.
+
+        Arguments:
+            server      --- Domain name of HTTP server.
+            path        --- Path on server.
+
+        Keyworded arguments:
+            method      --- HTTP request method.
+            headers     --- Additional HTTP headers.
+            payload     --- Dictionary containing data to send with request.
+            retry       --- Number of re-attempts on error.
+            compress    --- Send the payload gzipped.
 
         """
-        cls.log.debug("{}({}) {}{} << payload {}".format(method, retry, server, path, payload is not None))
+        info = RequestInfo(server, path, method)
+        start = time()
+        try:
+            for chunk in cls._stream(server, path, method, headers, payload, retry, compress, info):
+                yield chunk
+        except APIError as e:
+            info.error = e
+            raise
+        finally:
+            info.total = time() - start
+            cls._notify(info)
+
+    @classmethod
+    def _stream(cls, server, path, method, headers, payload, retry, compress, info):
+        """ Perform HTTP request, follow redirects and re-attempt on error. """
         req_headers = dict(cls.headers)
         req_headers.update(headers)
         if payload is not None and not isinstance(payload, bytes):
             payload = payload.encode("utf-8")
-        connection = HTTPConnection(server)
-        connection.connect()
-        connection.request(method, path, payload, req_headers)
-        response = connection.getresponse()
-        if response.status == 200:
-            body = response.read()
-            connection.close()
-            if server == OverpassAPI.server and response.getheader("Content-Type") != "application/osm3s+xml":
-                # Overpass API returns always status 200, grr!
-                raise APIError("Unexpected Content-type {}".format(response.getheader("Content-Type")), payload)
-            return body
-        elif response.status in (301, 302, 303, 307):
-            # Try to redirect
-            connection.close()
-            url = response.getheader("Location")
-            if url is None:
-                cls.log.error("Got code {}, but no location header.".format(response.status))
-                raise APIError("Unable to redirect the request.", payload)
-            url = unquote(url)
-            cls.log.debug("Redirecting to {}".format(url))
-            url = url.split("/", 3)
-            server = url[2]
-            path = "/" + url[3]
-            return cls.request(server, path, method=method, headers=headers, payload=payload, retry=retry)
-        elif 400 <= response.status < 500:
-            body = response.read().decode("utf-8", "replace").strip()
-            if not isinstance(body, str):
-                body = body.encode("utf-8")
-            connection.close()
-            cls.log.error("Got error {} ({}).".format(response.reason, response.status))
-            raise APIError(body, payload, response.reason, response.status)
-        else:
-            body = response.read().decode("utf-8", "replace").strip()
-            if not isinstance(body, str):
-                body = body.encode("utf-8")
-            connection.close()
-            if retry <= 0:
-                cls.log.error("Could not download {}{}".format(server, path))
+        data = payload
+        if payload is not None and compress:
+            data = cls._compress(payload)
+            req_headers["Content-Encoding"] = "gzip"
+        server, path = cls._redirect_target(server, path)
+        while True:
+            cls.log.debug("{}({}) {}{} << payload {}".format(method, retry, server, path, payload is not None))
+            response = cls.transport.request(server, method, path, data, req_headers, info)
+            info.status = response.status
+            if data is not None:
+                info.bytes_out += len(data)
+            if response.status == 200:
+                try:
+                    if server == OverpassAPI.server and response.getheader("Content-Type") not in ("application/osm3s+xml", "application/json"):
+                        # Overpass API returns always status 200, grr!
+                        raise APIError("Unexpected Content-type {}".format(response.getheader("Content-Type")), payload)
+                    for chunk in cls._iter_body(response, info):
+                        yield chunk
+                finally:
+                    response.close()
+                return
+            elif response.status in (301, 302, 303, 307, 308):
+                # Try to redirect
+                url = response.getheader("Location")
+                cls._read_error(response, info)
+                response.close()
+                if url is None:
+                    cls.log.error("Got code {}, but no location header.".format(response.status))
+                    raise APIError("Unable to redirect the request.", payload)
+                if info.redirects >= cls.max_redirects:
+                    cls.log.error("Exceeded maximum of {} redirects.".format(cls.max_redirects))
+                    raise APIError("Too many redirects.", payload)
+                url = urlsplit(urljoin("http://{}{}".format(server, path), url))
+                if url.scheme != "http":
+                    raise APIError("Unable to redirect the request to {}.".format(url.geturl()), payload)
+                target = (url.netloc, urlunsplit(("", "", url.path or "/", url.query, "")))
+                cls.log.debug("Redirecting to {}{}".format(*target))
+                if response.status in (301, 308):
+                    cls._remember_redirect((server, path), target)
+                server, path = target
+                info.redirects += 1
+            elif 400 <= response.status < 500:
+                body = cls._read_error(response, info)
+                response.close()
+                cls.log.error("Got error {} ({}).".format(response.reason, response.status))
                 raise APIError(body, payload, response.reason, response.status)
             else:
-                wait = 30
+                body = cls._read_error(response, info)
+                response.close()
+                if retry <= 0:
+                    cls.log.error("Could not download {}{}".format(server, path))
+                    raise APIError(body, payload, response.reason, response.status)
+                wait = cls.retry_wait
                 cls.log.warn("Got error {} ({})... will retry in {} seconds.".format(response.status, response.reason, wait))
                 cls.log.debug(body)
                 sleep(wait)
-                return cls.request(server, path, method=method, headers=headers, payload=payload, retry=retry-1)
+                retry -= 1
+                info.retries += 1
+
+    @classmethod
+    def _redirect_target(cls, server, path):
+        """ Return (server, path) after applying remembered permanent redirects. """
+        for hop in range(cls.max_redirects):
+            if (server, path) in cls.permanent_redirects:
+                server, path = cls.permanent_redirects[(server, path)]
+            elif (server, None) in cls.permanent_redirects:
+                server = cls.permanent_redirects[(server, None)][0]
+            else:
+                break
+        return server, path
+
+    @classmethod
+    def _remember_redirect(cls, source, target):
+        """ Remember permanent redirect, whole server if the path is kept. """
+        if source[1] == target[1]:
+            cls.permanent_redirects[(source[0], None)] = (target[0], None)
+        else:
+            cls.permanent_redirects[source] = target
+
+    @classmethod
+    def add_observer(cls, observer):
+        """
+        Register observer called with RequestInfo after every finished request.
+
+        Arguments:
+            observer    --- Callable accepting RequestInfo instance.
+
+        """
+        if observer not in cls.observers:
+            cls.observers.append(observer)
+
+    @classmethod
+    def remove_observer(cls, observer):
+        """
+        Unregister previously added observer.
+
+        Arguments:
+            observer    --- Callable accepting RequestInfo instance.
+
+        """
+        if observer in cls.observers:
+            cls.observers.remove(observer)
+
+    @classmethod
+    def _notify(cls, info):
+        """ Pass RequestInfo to all observers. """
+        for observer in list(cls.observers):
+            try:
+                observer(info)
+            except Exception:
+                cls.log.exception("Observer {!r} failed.".format(observer))
+
+    @classmethod
+    def _compress(cls, payload):
+        """ Gzip the payload. """
+        compressor = zlib.compressobj(cls.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(payload) + compressor.flush()
+
+    @classmethod
+    def _iter_body(cls, response, info=None):
+        """ Read the response body in chunks and decode its Content-Encoding. """
+        encoding = (response.getheader("Content-Encoding") or "identity").strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        elif encoding == "identity":
+            decompressor = None
+        else:
+            raise APIError("Unsupported Content-Encoding {}".format(encoding), None)
+        first = True
+        while True:
+            chunk = response.read(cls.chunk_size)
+            if not chunk:
+                break
+            if info is not None:
+                info.bytes_in += len(chunk)
+            if decompressor is None:
+                yield chunk
+                continue
+            if first and encoding == "deflate":
+                # Some servers send raw deflate stream without zlib header.
+                try:
+                    chunk = decompressor.decompress(chunk)
+                except zlib.error:
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    chunk = decompressor.decompress(chunk)
+            else:
+                chunk = decompressor.decompress(chunk)
+            first = False
+            if chunk:
+                yield chunk
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+    @classmethod
+    def _read_error(cls, response, info=None):
+        """ Read and decode body of error response. """
+        try:
+            body = b"".join(cls._iter_body(response, info))
+        except (APIError, zlib.error):
+            body = b""
+        body = body.decode("utf-8", "replace").strip()
+        if not isinstance(body, str):
+            body = body.encode("utf-8")
+        return body
 
 
 
@@ -188,6 +969,8 @@ class BaseReadAPI(object):
         get_way_full        --- Download way by id and all referenced nodes.
         get_relation_full   --- Download relation by id and all referenced members.
         get_full            --- Download way/relation and all elements that references.
+        get_full_many       --- Download all elements referenced by ways/relations
+                                in batches per level.
         get_nodes           --- Download nodes by ids.
         get_ways            --- Download ways by ids.
         get_relations       --- Download relations by ids.
@@ -342,6 +1125,65 @@ class BaseReadAPI(object):
             raise TypeError("Element must be a Way or Relation instance.")
         return self.get_element_full(element.xml_tag, element.id)
 
+    def get_full_many(self, elements, osm=None):
+        """
+        Download all elements referenced by ways/relations in batches per level.
+
+        Members are resolved level by level: member relations, then member
+        ways, then nodes of all the ways and node members, each level with
+        one get_elements call per type for all missing ids. Like with
+        get_full, members of member relations are not included.
+
+        Return OSM wrapper with the ways/relations and all referenced elements.
+        The given and local elements are copied into it, so they are not
+        shared with the result.
+
+        Arguments:
+            elements    --- Iterable with Way/Relation wrappers.
+
+        Keyworded arguments:
+            osm         --- OSM wrapper with local elements, that are used
+                            instead of downloading them.
+
+        """
+        result = wrappers["osm"]()
+        for element in elements:
+            if not isinstance(element, (Way, Relation)):
+                raise TypeError("Element must be a Way or Relation instance.")
+            result.add(self._copy(element))
+        wanted = {"node": set(), "way": set(), "relation": set()}
+        for relation in result.relations.values():
+            for member in relation.members:
+                wanted[member["type"]].add(member["ref"])
+        for type_ in ("relation", "way", "node"):
+            if type_ == "node":
+                for way in result.ways.values():
+                    wanted["node"].update(way.nds)
+            container = getattr(result, type_ + "s")
+            local = getattr(osm, type_ + "s") if osm is not None else {}
+            missing = []
+            for id_ in wanted[type_]:
+                if id_ in container:
+                    continue
+                elif id_ in local:
+                    result.add(self._copy(local[id_]))
+                else:
+                    missing.append(id_)
+            if len(missing) > 0:
+                for element in self.get_elements(type_, sorted(missing)):
+                    result.add(element)
+        return result
+
+    @staticmethod
+    def _copy(element):
+        """ Return copy of Node, Way, Relation wrapper without history. """
+        cls = wrappers[element.xml_tag]
+        if element.xml_tag == "node":
+            return cls(element.attribs, element.tags)
+        elif element.xml_tag == "way":
+            return cls(element.attribs, element.tags, element.nds)
+        return cls(element.attribs, element.tags, [dict(member) for member in element.members])
+
     @abstractmethod
     def get_elements(self, type_, ids):
         """
@@ -718,20 +1560,408 @@ class BaseWriteAPI(object):
         return self.delete_element(element, changeset)
 
 
-class OverpassAPI(BaseReadAPI):
-    """
-    OSM Overpass API interface.
+_ql_types = {"node": "node", "way": "way", "relation": "rel"}
+_ql_recurse = {"node-way": "way(bn)", "node-relation": "rel(bn)", "way-relation": "rel(bw)",
+               "relation-backwards": "rel(br)", "way-node": "node(w)", "relation-node": "node(r)",
+               "relation-way": "way(r)", "relation-relation": "rel(r)"}
 
-    Read calls are mostly compatible with standard API.
 
-    Class attributes:
-        http        --- Interface for accessing data over HTTP.
-        server      --- Domain name of OSM Overpass API.
-        basepath    --- Path to the API on the server.
+class _IdStatement(object):
+    """ Query elements of one type by ids. """
+
+    def __init__(self, type_, ids):
+        if type_ not in ("node", "way", "relation"):
+            raise ValueError("Type must be 'node', 'way' or 'relation'.")
+        self.type = type_
+        self.ids = sorted(set(int(id_) for id_ in ids))
+        if len(self.ids) == 0:
+            raise ValueError("At least one id is required.")
+
+    def ql(self):
+        return "{}(id:{});".format(_ql_types[self.type], ",".join(str(id_) for id_ in self.ids))
+
+    def xml(self):
+        queries = [ET.Element("id-query", {"type": self.type, "ref": str(id_)}) for id_ in self.ids]
+        if len(queries) == 1:
+            return queries[0]
+        union = ET.Element("union")
+        union.extend(queries)
+        return union
+
+
+class _BboxStatement(object):
+    """ Query nodes inside bbox. """
+
+    def __init__(self, left, bottom, right, top):
+        self.bbox = tuple(float(value) for value in (left, bottom, right, top))
+
+    def ql(self):
+        left, bottom, right, top = self.bbox
+        return "node({!r},{!r},{!r},{!r});".format(bottom, left, top, right)
+
+    def xml(self):
+        return ET.Element("bbox-query", dict(zip(("w", "s", "e", "n"), (repr(value) for value in self.bbox))))
+
+
+class _RecurseStatement(object):
+    """ Replace elements by the ones they reference or are referenced by. """
+
+    def __init__(self, type_):
+        if type_ not in _ql_recurse:
+            raise ValueError("Type must be one of {}.".format(", ".join(sorted(_ql_recurse))))
+        self.type = type_
+
+    def ql(self):
+        return _ql_recurse[self.type] + ";"
+
+    def xml(self):
+        return ET.Element("recurse", {"type": self.type})
+
+
+class _UnionStatement(object):
+    """ Union of results of statements. """
+
+    def __init__(self, statements):
+        self.statements = list(statements)
+
+    def ql(self):
+        return "({});".format("".join(statement.ql() for statement in self.statements))
+
+    def xml(self):
+        union = ET.Element("union")
+        union.extend(statement.xml() for statement in self.statements)
+        return union
+
+
+class _OutStatement(object):
+    """ Print elements. """
+
+    def __init__(self, mode, order):
+        if mode not in ("ids_only", "skeleton", "body", "tags", "meta"):
+            raise ValueError("Unknown print mode {!r}.".format(mode))
+        if order not in ("id", "quadtile"):
+            raise ValueError("Order must be 'id' or 'quadtile'.")
+        self.mode = mode
+        self.order = order
+
+    def ql(self):
+        words = ["out"]
+        if self.mode != "body":
+            words.append({"ids_only": "ids", "skeleton": "skel"}.get(self.mode, self.mode))
+        if self.order == "quadtile":
+            words.append("qt")
+        return " ".join(words) + ";"
+
+    def xml(self):
+        attribs = {"mode": self.mode}
+        if self.order == "quadtile":
+            attribs["order"] = "quadtile"
+        return ET.Element("print", attribs)
+
+
+class OverpassQuery(object):
+    """
+    Builder of canonical Overpass queries.
+
+    Statements are added by chained methods. Ids are sorted and
+    deduplicated and coordinates normalized, so equal queries render into
+    the same Overpass QL or XML and get the same key.
+
+        query = OverpassQuery().ids("way", [2, 1]).recurse("way-node").out()
+
+    Class methods:
+        union       --- Create query with union of statements of queries.
+
+    Attributes:
+        statements  --- List of statements.
+
+    Methods:
+        ids         --- Add query of node/way/relation by ids.
+        bbox        --- Add query of nodes inside bbox.
+        recurse     --- Add recursion to referenced or referencing elements.
+        out         --- Add print of the current elements.
+        to_ql       --- Return Overpass QL string of the query.
+        to_xml      --- Get ET.Element representation of the query.
+        key         --- Return hash of canonical form of the query.
+
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @classmethod
+    def union(cls, *queries):
+        """
+        Create query with union of statements of queries.
+
+        Arguments:
+            queries     --- OverpassQuery instances.
+
+        """
+        query = cls()
+        query.statements.append(_UnionStatement(chain.from_iterable(q.statements for q in queries)))
+        return query
+
+    def ids(self, type_, ids):
+        """
+        Add query of node/way/relation by ids.
+
+        Arguments:
+            type_       --- Elements type (node/way/relation).
+            ids         --- Iterable with ids.
+
+        """
+        self.statements.append(_IdStatement(type_, ids))
+        return self
+
+    def bbox(self, left, bottom, right, top):
+        """
+        Add query of nodes inside bbox.
+
+        Arguments:
+            left        --- Left boundary.
+            bottom      --- Bottom boundary.
+            right       --- Right boundary.
+            top         --- Top boundary.
+
+        """
+        self.statements.append(_BboxStatement(left, bottom, right, top))
+        return self
+
+    def recurse(self, type_):
+        """
+        Add recursion to referenced or referencing elements.
+
+        Arguments:
+            type_       --- Recurse type of Overpass XML, e.g. 'way-node',
+                            'node-relation' or 'relation-backwards'.
+
+        """
+        self.statements.append(_RecurseStatement(type_))
+        return self
+
+    def out(self, mode="meta", order="quadtile"):
+        """
+        Add print of the current elements.
+
+        Keyworded arguments:
+            mode        --- Print mode (ids_only, skeleton, body, tags, meta).
+            order       --- Order of elements (id, quadtile).
+
+        """
+        self.statements.append(_OutStatement(mode, order))
+        return self
+
+    def to_ql(self):
+        """ Return Overpass QL string of the query. """
+        return "".join(statement.ql() for statement in self.statements)
+
+    def to_xml(self):
+        """ Get ET.Element representation of the query. """
+        script = ET.Element("osm-script")
+        script.extend(statement.xml() for statement in self.statements)
+        return script
+
+    def key(self):
+        """ Return hash of canonical form of the query. """
+        return hashlib.sha1(self.to_ql().encode("utf-8")).hexdigest()
+
+    def __str__(self):
+        return self.to_ql()
+
+    def __eq__(self, other):
+        return isinstance(other, OverpassQuery) and self.to_ql() == other.to_ql()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.to_ql())
+
+
+class OverpassCache(object):
+    """
+    Cache of Overpass results by query hash.
+
+    Results are kept pickled, every hit returns a new copy of the wrappers.
+    With directory they are also persisted in files named by the key, so
+    the cache survives between runs. Expired results are removed when they
+    are looked up.
+
+    WARNING: Persisted results are unpickled, use only directory that can
+             be written solely by trusted users!
+
+    Attributes:
+        ttl         --- Number of seconds the results are valid, None forever.
+        directory   --- Directory of persisted results or None.
+        hits        --- Number of served results.
+        misses      --- Number of queries not found in the cache.
+
+    Methods:
+        key         --- Return key of query sent to server.
+        get         --- Return cached OSM wrapper or None.
+        put         --- Store OSM wrapper.
+        clear       --- Forget all results.
+
+    """
+
+    def __init__(self, ttl=3600, directory=None):
+        """
+        Keyworded arguments:
+            ttl         --- Number of seconds the results are valid, None forever.
+            directory   --- Directory of persisted results, None keeps them
+                            only in memory.
+
+        """
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, server, basepath, query):
+        """
+        Return key of query sent to server.
+
+        Whitespace between elements of XML query is ignored, QL string is
+        used as it is.
+
+        Arguments:
+            server      --- Domain name of the server.
+            basepath    --- Path to the API on the server.
+            query       --- OverpassQuery, ET.Element or string.
+
+        """
+        if isinstance(query, OverpassQuery):
+            query = query.to_ql()
+        if isinstance(query, bytes):
+            query = query.decode("utf-8")
+        if not ET.iselement(query) and query.lstrip().startswith("<"):
+            try:
+                query = ET.XML(query.strip().encode("utf-8"))
+            except ET.ParseError:
+                pass
+        if ET.iselement(query):
+            query = copy.deepcopy(query)
+            for element in query.iter():
+                if element.text is not None and element.text.strip() == "":
+                    element.text = None
+                if element.tail is not None and element.tail.strip() == "":
+                    element.tail = None
+            query = ET.tostring(query, encoding="utf-8").decode("utf-8")
+        return hashlib.sha1(u"{}\n{}\n{}".format(server, basepath, query).encode("utf-8")).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _expired(self, stored):
+        return self.ttl is not None and time() - stored > self.ttl
+
+    def get(self, key):
+        """
+        Return cached OSM wrapper or None.
+
+        Arguments:
+            key         --- Key of the query.
+
+        """
+        with self._lock:
+            stored, data = self._data.get(key, (None, None))
+            if data is None and self.directory is not None and os.path.exists(self._filename(key)):
+                stored = os.path.getmtime(self._filename(key))
+                with open(self._filename(key), "rb") as fp:
+                    data = fp.read()
+                self._data[key] = (stored, data)
+            if data is not None and self._expired(stored):
+                del self._data[key]
+                if self.directory is not None:
+                    try:
+                        os.remove(self._filename(key))
+                    except OSError:
+                        pass
+                data = None
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(data)
+
+    def put(self, key, osm):
+        """
+        Store OSM wrapper.
+
+        Arguments:
+            key         --- Key of the query.
+            osm         --- OSM wrapper.
+
+        """
+        data = pickle.dumps(osm, 2)
+        with self._lock:
+            self._data[key] = (time(), data)
+            if self.directory is not None:
+                temporary = "{}.{}".format(self._filename(key), threading.current_thread().ident)
+                with open(temporary, "wb") as fp:
+                    fp.write(data)
+                if hasattr(os, "replace"):
+                    os.replace(temporary, self._filename(key))
+                else:
+                    # Python 2.x compatibility
+                    if os.path.exists(self._filename(key)):
+                        os.remove(self._filename(key))
+                    os.rename(temporary, self._filename(key))
+
+    def clear(self):
+        """ Forget all results, including the persisted ones. """
+        with self._lock:
+            self._data = {}
+            if self.directory is not None:
+                for filename in os.listdir(self.directory):
+                    if filename.endswith(".pickle"):
+                        os.remove(os.path.join(self.directory, filename))
+
+
+def _quadrants(bbox):
+    """ Split (left, bottom, right, top) bbox into four quadrants. """
+    left, bottom, right, top = bbox
+    x = (left + right) / 2.0
+    y = (bottom + top) / 2.0
+    return [(left, bottom, x, y), (x, bottom, right, y), (left, y, x, top), (x, y, right, top)]
+
+
+class OverpassAPI(BaseReadAPI):
+    """
+    OSM Overpass API interface.
+
+    Read calls are mostly compatible with standard API.
+
+    Class attributes:
+        http        --- Interface for accessing data over HTTP.
+        server      --- Domain name of OSM Overpass API.
+        basepath    --- Path to the API on the server.
+        output      --- Output format requested from interpreter, 'xml' or 'json'.
+        slots       --- Number of concurrent requests allowed by the server.
+        density     --- Estimated number of elements per square degree, used
+                        to size tiles of get_bbox_tiled.
+        tile_elements --- Estimated number of elements per tile of get_bbox_tiled.
+        tile_retry  --- Number of re-attempts of a tile before it is split.
+        min_tile    --- Minimal width and height of a tile in degrees.
+        id_batch    --- Maximum number of ids in one request of id based queries.
+        cache       --- OverpassCache of interpreter results or None.
 
     Methods:
         request     --- Low-level method to retrieve data from server.
         interpreter --- Send request to interpreter and return OSM wrapper.
+        iterinterpreter --- Send request to interpreter and iterate over wrappers
+                        as the response is downloaded.
+        get_bbox_tiled --- Download OSM data inside the bbox in concurrently
+                        fetched tiles.
+        get_element_rels_many --- Download relations that reference any of the
+                        nodes/ways/relations by ids.
+        get_node_ways_many --- Download ways that reference any of the nodes
+                        by ids or wrappers.
 
     Methods (required by BaseReadAPI):
         get_bbox            --- Download OSM data inside the specified bbox.
@@ -746,8 +1976,17 @@ class OverpassAPI(BaseReadAPI):
     http = HTTPClient
     server = "www.overpass-api.de"
     basepath = "/api/"
-
-    def request(self, path, data):
+    output = "xml"
+    slots = 2
+    density = 1e7
+    tile_elements = 500000
+    tile_retry = 1
+    min_tile = 0.001
+    id_batch = 1000
+    cache = None
+    log = logging.getLogger("osmapis.overpass")
+
+    def request(self, path, data, parse=False, stream=False, retry=10):
         """
         Low-level method to retrieve data from server.
 
@@ -755,22 +1994,82 @@ class OverpassAPI(BaseReadAPI):
             path        --- One of 'interpreter', 'get_rule', 'add_rule', 'update_rule'.
             data        --- Data to send with the request.
 
+        Keyworded arguments:
+            parse       --- Return parsed ET.Element instead of string.
+            stream      --- Return iterator over chunks of the body instead of string.
+            retry       --- Number of re-attempts on error.
+
         """
         path = "{}{}".format(self.basepath, path)
         payload = urlencode({"data": data})
-        return self.http.request(self.server, path, method="POST", payload=payload)
+        if parse:
+            return self.http.request_xml(self.server, path, method="POST", payload=payload, retry=retry)
+        if stream:
+            return self.http.stream(self.server, path, method="POST", payload=payload, retry=retry)
+        return self.http.request(self.server, path, method="POST", payload=payload, retry=retry)
 
-    def interpreter(self, query):
+    def interpreter(self, query, retry=10):
         """
         Send request to interpreter and return OSM wrapper.
 
+        Results of repeated queries are served from cache, if it's set.
+
         Arguments:
-            query       --- ET.Element or string.
+            query       --- OverpassQuery, ET.Element or string.
+
+        Keyworded arguments:
+            retry       --- Number of re-attempts on error.
 
         """
-        if ET.iselement(query):
+        if self.cache is None:
+            return wrappers["osm"]._merged(self.iterinterpreter(query, retry=retry))
+        key = self.cache.key(self.server, self.basepath, query)
+        osm = self.cache.get(key)
+        if osm is None:
+            osm = wrappers["osm"]._merged(self.iterinterpreter(query, retry=retry))
+            self.cache.put(key, osm)
+        return osm
+
+    def iterinterpreter(self, query, strings=None, retry=10):
+        """
+        Send request to interpreter and iterate over Node, Way, Relation wrappers
+        as the response is downloaded.
+
+        The response is requested in the format given by output attribute,
+        it's never cached. Runtime error reported by the server in remark of
+        the response raises APIError, after the elements preceding it.
+
+        Arguments:
+            query       --- OverpassQuery, ET.Element or string.
+
+        Keyworded arguments:
+            strings     --- InternTable deduplicating strings, new one by default.
+            retry       --- Number of re-attempts on error.
+
+        """
+        if isinstance(query, OverpassQuery):
+            query = query.to_ql()
+        elif ET.iselement(query):
             query = ET.tostring(query, encoding="utf-8")
-        return wrappers["osm"].from_xml(self.request("interpreter", query))
+        if isinstance(query, bytes):
+            query = query.decode("utf-8")
+        if strings is None:
+            strings = InternTable()
+        remarks = []
+        if self.output == "json":
+            chunks = self.request("interpreter", _json_query(query), stream=True, retry=retry)
+            for element in _json_elements(chunks, strings, remarks):
+                yield element
+        elif self.output == "xml":
+            chunks = self.request("interpreter", query, stream=True, retry=retry)
+            for parent, element in parser.elements(_xml_remarks(chunks, remarks), 1, strings):
+                yield element
+        else:
+            raise ValueError("Output must be 'xml' or 'json'.")
+        for remark in remarks:
+            if remark.startswith("runtime error"):
+                self.log.error("Overpass {}".format(remark))
+                raise APIError(remark, query)
 
     ##################################################
     # READ API                                       #
@@ -788,16 +2087,130 @@ class OverpassAPI(BaseReadAPI):
             top         --- Top boundary.
 
         """
-        query = """<union>
-                        <bbox-query w="{}" s="{}" e="{}" n="{}"/>
-                        <recurse type="node-relation"/>
-                        <recurse type="node-way"/>
-                        <recurse type="way-relation"/>
-                        <recurse type="way-node"/>
-                        <recurse type="node-relation"/>
-                   </union>
-                   <print mode="meta" order="quadtile"/>""".format(left, bottom, right, top)
-        return self.interpreter(query)
+        return self.interpreter(self._bbox_query(left, bottom, right, top))
+
+    def _bbox_query(self, left, bottom, right, top):
+        query = OverpassQuery().bbox(left, bottom, right, top)
+        for type_ in ("node-relation", "node-way", "way-relation", "way-node", "node-relation"):
+            query.recurse(type_)
+        return OverpassQuery.union(query).out()
+
+    def get_bbox_tiled(self, left, bottom, right, top, density=None, progress=None):
+        """
+        Download OSM data inside the bbox in concurrently fetched tiles.
+
+        The bbox is split into quadtiles with estimated number of elements up
+        to tile_elements. Tiles are downloaded in up to slots parallel
+        requests, a tile that keeps failing on timeout, server error or out of
+        memory error is split into quadrants, until min_tile size is reached.
+        Other errors are raised at once. Elements shared by tiles are merged,
+        the result is the same as of get_bbox.
+
+        Return OSM wrapper.
+
+        Arguments:
+            left        --- Left boundary.
+            bottom      --- Bottom boundary.
+            right       --- Right boundary.
+            top         --- Top boundary.
+
+        Keyworded arguments:
+            density     --- Estimated number of elements per square degree,
+                            density attribute by default.
+            progress    --- Callable called with (done, total) number of tiles
+                            after every downloaded tile.
+
+        """
+        if density is None:
+            density = self.density
+        tiles = []
+        pending = [(left, bottom, right, top)]
+        while len(pending) > 0:
+            tile = pending.pop()
+            if (tile[2] - tile[0]) * (tile[3] - tile[1]) * density > self.tile_elements and self._splittable(tile):
+                pending.extend(reversed(_quadrants(tile)))
+            else:
+                tiles.append(tile)
+        osm = wrappers["osm"]()
+        pool = ThreadPool(max(1, min(self.slots, len(tiles))))
+        try:
+            results = [(tile, pool.apply_async(self._get_tile, tile)) for tile in tiles]
+            done = 0
+            while len(results) > 0:
+                tile, result = results.pop(0)
+                try:
+                    data = result.get()
+                except (APIError, socket.error) as e:
+                    if not self._splittable(tile) or not self._transient(e):
+                        raise
+                    self.log.warning("Tile {} failed, splitting it.".format(tile))
+                    results.extend((quadrant, pool.apply_async(self._get_tile, quadrant)) for quadrant in _quadrants(tile))
+                    continue
+                self._add_new(osm, data)
+                done += 1
+                self.log.debug("Downloaded tile {}, {}/{} done.".format(tile, done, done + len(results)))
+                if progress is not None:
+                    progress(done, done + len(results))
+        finally:
+            pool.terminate()
+            pool.join()
+        return osm
+
+    @staticmethod
+    def _add_new(osm, elements):
+        """ Add elements that are not yet in OSM wrapper. """
+        for element in elements:
+            if element.id not in getattr(osm, element.xml_tag + "s"):
+                osm.add(element)
+
+    def _batched(self, type_, ids, recurse=None):
+        """
+        Send id query for batches of ids in up to slots parallel requests.
+
+        Return OSM wrapper with merged results.
+
+        Arguments:
+            type_       --- Elements type (node/way/relation).
+            ids         --- Iterable with ids.
+
+        Keyworded arguments:
+            recurse     --- Recurse type applied to the elements.
+
+        """
+        ids = sorted(set(int(id_) for id_ in ids))
+        queries = []
+        for i in range(0, len(ids), self.id_batch):
+            query = OverpassQuery().ids(type_, ids[i:i + self.id_batch])
+            if recurse is not None:
+                query.recurse(recurse)
+            queries.append(query.out())
+        if len(queries) <= 1:
+            return self.interpreter(queries[0]) if len(queries) == 1 else wrappers["osm"]()
+        pool = ThreadPool(min(self.slots, len(queries)))
+        try:
+            results = pool.map(self.interpreter, queries)
+        finally:
+            pool.close()
+            pool.join()
+        osm = wrappers["osm"]()
+        for result in results:
+            self._add_new(osm, result)
+        return osm
+
+    def _splittable(self, tile):
+        return tile[2] - tile[0] >= 2 * self.min_tile and tile[3] - tile[1] >= 2 * self.min_tile
+
+    @staticmethod
+    def _transient(error):
+        """ Check whether the error is timeout, server or out of memory error. """
+        if not isinstance(error, APIError):
+            return True
+        if error.http_status is not None:
+            return error.http_status >= 500
+        return _overpass_split_error.search(str(error.reason)) is not None
+
+    def _get_tile(self, left, bottom, right, top):
+        return self.interpreter(self._bbox_query(left, bottom, right, top), retry=self.tile_retry)
 
     def get_element(self, type_, id_, version=None):
         """
@@ -819,9 +2232,7 @@ class OverpassAPI(BaseReadAPI):
             raise NotImplementedError("Version calls are not supported.")
         if type_ not in ("node", "way", "relation"):
             raise ValueError("Type must be 'node', 'way' or 'relation'.")
-        query = '<id-query type="{}" ref="{}"/>'.format(type_, id_)
-        query += '<print mode="meta"/>'
-        osm = self.interpreter(query)
+        osm = self.interpreter(OverpassQuery().ids(type_, [id_]).out(order="id"))
         return getattr(osm, type_ + "s")[id_]
 
     def get_element_full(self, type_, id_):
@@ -837,16 +2248,13 @@ class OverpassAPI(BaseReadAPI):
         """
         if type_ not in ("way", "relation"):
             raise ValueError("Type must be from {}.".format(", ".join(("way", "relation"))))
-        query = '<id-query type="{}" ref="{}"/>'.format(type_, id_)
+        query = OverpassQuery().ids(type_, [id_])
         if type_ == "way":
-            query += '<recurse type="way-node"/>'
+            query.recurse("way-node")
         else:
-            query += '<recurse type="relation-way"/>'
-            query += '<recurse type="relation-node"/>'
-            query += '<recurse type="relation-relation"/>'
-            query += '<recurse type="way-node"/>'
-        query += '<print mode="meta" order="quadtile"/>'
-        return self.interpreter(query)
+            for recurse in ("relation-way", "relation-node", "relation-relation", "way-node"):
+                query.recurse(recurse)
+        return self.interpreter(query.out())
 
     def get_elements(self, type_, ids):
         """
@@ -861,11 +2269,7 @@ class OverpassAPI(BaseReadAPI):
         """
         if type_ not in ("node", "way", "relation"):
             raise ValueError("Type must be 'node', 'way' or 'relation'.")
-        query = ''
-        for id_ in ids:
-            query += '<id-query type="{}" ref="{}"/>'.format(type_, id_)
-        query += '<print mode="meta" order="quadtile"/>'
-        return self.interpreter(query)
+        return self._batched(type_, ids)
 
     def get_element_rels(self, type_, id_):
         """
@@ -880,13 +2284,12 @@ class OverpassAPI(BaseReadAPI):
         """
         if type_ not in ("node", "way", "relation"):
             raise ValueError("Type must be 'node', 'way' or 'relation'.")
-        query = '<id-query type="{}" ref="{}" into="child"/>'.format(type_, id_)
+        query = OverpassQuery().ids(type_, [id_])
         if type_ == "relation":
-            query += '<recurse type="relation-backwards" from="child"/>'
+            query.recurse("relation-backwards")
         else:
-            query += '<recurse type="{}-relation" from="child"/>'.format(type_)
-        query += '<print mode="meta" order="quadtile"/>'
-        return self.interpreter(query)
+            query.recurse("{}-relation".format(type_))
+        return self.interpreter(query.out())
 
     def get_node_ways(self, element):
         """
@@ -900,10 +2303,235 @@ class OverpassAPI(BaseReadAPI):
         """
         if isinstance(element, Node):
             element = element.id
-        query = '<id-query type="node" ref="{}" into="parent"/>'.format(element)
-        query += '<recurse type="node-way" from="parent"/>'
-        query += '<print mode="meta" order="quadtile"/>'
-        return self.interpreter(query)
+        return self.interpreter(OverpassQuery().ids("node", [element]).recurse("node-way").out())
+
+    def get_element_rels_many(self, type_, ids):
+        """
+        Download relations that reference any of the nodes/ways/relations by ids.
+
+        Return OSM wrapper.
+
+        Arguments:
+            type_       --- Elements type (node/way/relation).
+            ids         --- Iterable with ids.
+
+        """
+        if type_ not in ("node", "way", "relation"):
+            raise ValueError("Type must be 'node', 'way' or 'relation'.")
+        recurse = "relation-backwards" if type_ == "relation" else "{}-relation".format(type_)
+        return self._batched(type_, ids, recurse)
+
+    def get_node_ways_many(self, elements):
+        """
+        Download ways that reference any of the nodes by ids or wrappers.
+
+        Return OSM wrapper.
+
+        Arguments:
+            elements    --- Iterable with Node wrappers or ids.
+
+        """
+        ids = (element.id if isinstance(element, Node) else element for element in elements)
+        return self._batched("node", ids, "node-way")
+
+
+class ChangesetManager(object):
+    """
+    Thread-safe manager of automagically created changesets.
+
+    Every thread writing through API gets its own open changeset, so
+    several changesets can be open and filled in parallel. A changeset is
+    replaced when it reaches changeset_maxsize of the API.
+
+    The changeset lifecycle is pipelined: once a changeset is filled up to
+    the prefetch fraction, the next one is opened in background, and full
+    changesets are closed in background, so writes don't wait for these
+    round-trips on rollover.
+
+    Attributes:
+        api         --- API instance used to open and close changesets.
+        prefetch    --- Fraction of changeset_maxsize after which the next
+                        changeset is opened in background, None disables it.
+        workers     --- Number of background threads.
+        open        --- List of currently open changesets, read-only.
+
+    Methods:
+        acquire     --- Return open changeset of the current thread with space for elements.
+        check       --- Close changeset of the current thread if full or requested.
+        spawn       --- Open new changeset in background.
+        retire      --- Close changeset in background.
+        wait        --- Wait until all background closing is done.
+        close       --- Close all open changesets.
+
+    """
+
+    log = logging.getLogger("osmapis.changesets")
+
+    def __init__(self, api, prefetch=0.9, workers=2):
+        """
+        Arguments:
+            api         --- API instance used to open and close changesets.
+
+        Keyworded arguments:
+            prefetch    --- Fraction of changeset_maxsize after which the next
+                            changeset is opened in background, None disables it.
+            workers     --- Number of background threads.
+
+        """
+        self.api = api
+        self.prefetch = prefetch
+        self.workers = int(workers)
+        self._lock = threading.Lock()
+        self._assigned = {}
+        self._spares = {}
+        self._pending = []
+        self._pool = None
+
+    @property
+    def open(self):
+        """ List of currently open changesets """
+        with self._lock:
+            return list(self._assigned.values())
+
+    def acquire(self, size=1):
+        """
+        Return open changeset of the current thread with space for size elements.
+
+        The space is reserved by increasing changeset.counter.
+
+        Keyworded arguments:
+            size        --- Number of elements to reserve.
+
+        """
+        key = threading.current_thread().ident
+        maxsize = self.api.changeset_maxsize
+        with self._lock:
+            changeset = self._assigned.get(key)
+            if changeset is not None and changeset.counter > 0 and changeset.counter + size > maxsize:
+                del self._assigned[key]
+                full, changeset = changeset, None
+            else:
+                full = None
+        if full is not None:
+            self.retire(full)
+        if changeset is None:
+            changeset = self._next(key)
+            with self._lock:
+                self._assigned[key] = changeset
+        changeset.counter += size
+        if self.prefetch is not None and changeset.counter >= self.prefetch * maxsize:
+            with self._lock:
+                prefetch = key not in self._spares
+            if prefetch:
+                spare = self.spawn()
+                with self._lock:
+                    self._spares[key] = spare
+        return changeset
+
+    def check(self, close=False):
+        """
+        Close changeset of the current thread if it reached the maximum size.
+
+        Full changeset is closed in background, explicitly requested close
+        is done immediately.
+
+        Keyworded arguments:
+            close       --- Close the changeset regardless of its size.
+
+        """
+        key = threading.current_thread().ident
+        with self._lock:
+            changeset = self._assigned.get(key)
+            if changeset is None or not (close or changeset.counter >= self.api.changeset_maxsize):
+                return
+            del self._assigned[key]
+        if close:
+            self.api.close_changeset(changeset)
+        else:
+            self.retire(changeset)
+
+    def spawn(self):
+        """
+        Open new changeset in background.
+
+        Return AsyncResult with Changeset wrapper.
+
+        """
+        return self._background(self._create)
+
+    def retire(self, changeset):
+        """
+        Close changeset in background.
+
+        Return AsyncResult.
+
+        Arguments:
+            changeset   --- Changeset wrapper or changeset id.
+
+        """
+        result = self._background(self._close, changeset)
+        with self._lock:
+            self._pending = [pending for pending in self._pending if not pending.ready()]
+            self._pending.append(result)
+        return result
+
+    def wait(self):
+        """ Wait until all background closing is done. """
+        with self._lock:
+            pending = list(self._pending)
+            self._pending = []
+        for result in pending:
+            result.wait()
+
+    def close(self):
+        """ Close all open changesets. """
+        with self._lock:
+            changesets = list(self._assigned.values())
+            spares = list(self._spares.values())
+            self._assigned.clear()
+            self._spares.clear()
+        for spare in spares:
+            try:
+                changesets.append(spare.get())
+            except Exception:
+                pass
+        for changeset in changesets:
+            self.retire(changeset)
+        self.wait()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _background(self, func, *args):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool.apply_async(func, args)
+
+    def _create(self):
+        changeset = self.api.create_changeset()
+        changeset.counter = 0
+        return changeset
+
+    def _close(self, changeset):
+        try:
+            self.api.close_changeset(changeset)
+        except Exception:
+            self.log.exception("Closing of changeset {} failed.".format(getattr(changeset, "id", changeset)))
+            raise
+
+    def _next(self, key):
+        """ Return prefetched changeset for the thread or open new one. """
+        with self._lock:
+            spare = self._spares.pop(key, None)
+        if spare is not None:
+            try:
+                return spare.get()
+            except Exception:
+                self.log.warning("Prefetching of changeset failed, opening new one.")
+        return self._create()
 
 
 class API(BaseReadAPI, BaseWriteAPI):
@@ -916,6 +2544,7 @@ class API(BaseReadAPI, BaseWriteAPI):
         basepath        --- Path to the API on the server.
         version         --- Version of OSM API.
         changeset_tags  --- Default tags to use when creating changeset.
+        multi_fetch     --- Maximum number of ids in one request of get_elements.
 
     Attributes:
         username        --- Username for API authentication
@@ -923,8 +2552,11 @@ class API(BaseReadAPI, BaseWriteAPI):
         capabilities    --- OSM API capabilities, read-only.
         changeset_autocreate --- Should we automagically create new changesets as needed?
         changeset_maxsize --- Maximum size of automagically created changesets.
+        compress_uploads --- Should we gzip payloads of diff uploads?
+        changesets      --- ChangesetManager of automagically created changesets.
 
     Methods:
+        close               --- Close all automagically created changesets.
         request             --- Low-level method to retrieve data from server.
         get                 --- Low-level method for GET request.
         put                 --- Low-level method for PUT request.
@@ -933,6 +2565,8 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         get_changeset_id    --- Return changeset id as string or raise Exception.
         check_auto_changeset --- Check automagically created changeset and close it if needed.
+        batch               --- Return BatchSession queueing writes into diff uploads.
+        upload_diffs        --- Upload independent OSC diffs in parallel threads.
 
         get_changeset       --- Download changeset by id.
         get_changeset_full  --- Download changeset contents by id.
@@ -961,13 +2595,13 @@ class API(BaseReadAPI, BaseWriteAPI):
     http = HTTPClient
     log = logging.getLogger("osmapis.api")
     _capabilities = None
-    _changeset = None
     version = 0.6
     server = "api.openstreetmap.org"
     basepath = "/api/{}/".format(version)
     changeset_tags = {"created_by": "osmapis/{0}".format(__version__)}
+    multi_fetch = 500
 
-    def __init__(self, username="", password="", changeset_autocreate=True, changeset_maxsize=1000, changeset_tags={}):
+    def __init__(self, username="", password="", changeset_autocreate=True, changeset_maxsize=1000, changeset_tags={}, compress_uploads=False):
         """
         Keyworded arguments:
             username        --- Username for API authentication
@@ -975,24 +2609,36 @@ class API(BaseReadAPI, BaseWriteAPI):
             changeset_autocreate --- Should we automagically create new changesets as needed?
             changeset_maxsize --- Maximum size of automagically creted changesets.
             changeset_tags  --- Default tags to use when creating changeset.
+            compress_uploads --- Should we gzip payloads of diff uploads?
 
         """
         self.username = username
         self.password = password
         self.changeset_autocreate = bool(changeset_autocreate)
         self.changeset_maxsize = int(changeset_maxsize)
+        self.compress_uploads = bool(compress_uploads)
         self.changeset_tags = dict(self.changeset_tags)
         self.changeset_tags.update(changeset_tags)
+        self.changesets = ChangesetManager(self)
 
-    def __del__(self):
-        self.check_auto_changeset(close=True)
-        return None
+    def __enter__(self):
+        return self
 
-    def get_changeset_id(self, changeset=None):
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
         """
-        Return changeset id as string or raise Exception.
+        Close all automagically created changesets.
 
-        If changeset_autocreate is enabled and no valid changeset or its id is passed,
+        """
+        self.changesets.close()
+
+    def get_changeset_id(self, changeset=None):
+        """
+        Return changeset id as string or raise Exception.
+
+        If changeset_autocreate is enabled and no valid changeset or its id is passed,
         return automagic changeset id.
 
         Keyworded arguments:
@@ -1007,27 +2653,58 @@ class API(BaseReadAPI, BaseWriteAPI):
         elif isinstance(changeset, int):
             return str(changeset)
         elif self.changeset_autocreate:
-            self.check_auto_changeset()
-            if self._changeset is None:
-                self._changeset = self.create_changeset()
-                self._changeset.counter = 0
-            self._changeset.counter += 1
-            return str(self._changeset.id)
+            return str(self.changesets.acquire().id)
         else:
             raise TypeError("Automagic changeset creation is disabled and no valid changeset or its id was passed.")
 
     def check_auto_changeset(self, close=False):
         """
-        Check automagically created changeset and close it if needed.
+        Check automagically created changeset of the current thread and close it if needed.
 
         Changeset is closed, if close is True or it reached the maximum allowed size.
 
         """
-        if self._changeset is None:
-            return
-        if close or self._changeset.counter >= self.changeset_maxsize:
-            self.close_changeset(self._changeset)
-            self._changeset = None
+        self.changesets.check(close=close)
+
+    def upload_diffs(self, oscs, threads=4):
+        """
+        Upload independent OSC diffs in parallel threads.
+
+        Each diff is uploaded by upload_diff into its own automagically created
+        changesets, so the diffs must not depend on each other.
+
+        Return list of upload_diff results in order of oscs.
+
+        Arguments:
+            oscs        --- Iterable of OSC wrappers.
+
+        Keyworded arguments:
+            threads     --- Number of parallel uploads.
+
+        """
+        oscs = list(oscs)
+        if len(oscs) == 0:
+            return []
+        pool = ThreadPool(min(threads, len(oscs)))
+        try:
+            return pool.map(self.upload_diff, oscs, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def batch(self, flush_size=None, flush_interval=None, changeset=None):
+        """
+        Return BatchSession queueing writes into diff uploads.
+
+        Keyworded arguments:
+            flush_size      --- Number of queued elements triggering upload,
+                                changeset_maxsize by default.
+            flush_interval  --- Age in seconds of the oldest queued element
+                                triggering upload, None means no limit.
+            changeset       --- Changeset wrapper, changeset id or None (create new).
+
+        """
+        return BatchSession(self, flush_size=flush_size, flush_interval=flush_interval, changeset=changeset)
 
     def _format_payload(self, element, changeset_id, main_tag_only=False):
         """ Format payload data """
@@ -1050,7 +2727,7 @@ class API(BaseReadAPI, BaseWriteAPI):
         """ Get value of Authorization header. """
         return "Basic " + b64encode("{}:{}".format(self.username, self.password).encode("utf-8")).decode().strip()
 
-    def request(self, path, payload=None, method="GET", auth=False):
+    def request(self, path, payload=None, method="GET", auth=False, parse=False, compress=False):
         """
         Low-level method to retrieve data from server.
 
@@ -1061,23 +2738,30 @@ class API(BaseReadAPI, BaseWriteAPI):
             payload     --- Data to send with the request.
             method      --- HTTP method to use for request.
             auth        --- Add Authorization header.
+            parse       --- Return parsed ET.Element instead of string.
+            compress    --- Send the payload gzipped.
 
         """
         path = "{}{}".format(self.basepath, path)
         headers = {}
         if auth:
             headers["Authorization"] = self._get_auth_header()
-        return self.http.request(self.server, path, method=method, headers=headers, payload=payload)
+        if parse:
+            return self.http.request_xml(self.server, path, method=method, headers=headers, payload=payload, compress=compress)
+        return self.http.request(self.server, path, method=method, headers=headers, payload=payload, compress=compress)
 
-    def get(self, path):
+    def get(self, path, parse=False):
         """
         Low-level method for GET request.
 
         Arguments:
             path        --- Path to download.
 
+        Keyworded arguments:
+            parse       --- Return parsed ET.Element instead of string.
+
         """
-        return self.request(path)
+        return self.request(path, parse=parse)
 
     def put(self, path, payload=None):
         """
@@ -1105,7 +2789,7 @@ class API(BaseReadAPI, BaseWriteAPI):
         """
         return self.request(path, payload=payload, method="DELETE", auth=True)
 
-    def post(self, path, payload=None):
+    def post(self, path, payload=None, compress=False):
         """
         Low-level method for POST request.
 
@@ -1114,9 +2798,10 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         Keyworded arguments:
             payload     --- Data to send with the request.
+            compress    --- Send the payload gzipped.
 
         """
-        return self.request(path, payload=payload, method="POST", auth=True)
+        return self.request(path, payload=payload, method="POST", auth=True, compress=compress)
 
     ##################################################
     # capabilities                                   #
@@ -1131,7 +2816,7 @@ class API(BaseReadAPI, BaseWriteAPI):
     def get_capabilities(self):
         """ Download and return dictionary with OSM API capabilities. """
         capabilities = {}
-        data = ET.XML(self.http.request(self.server, "/api/capabilities"))
+        data = self.http.request_xml(self.server, "/api/capabilities")
         for element in data.find("api"):
             capabilities[element.tag] = {}
             for key, value in element.attrib.items():
@@ -1158,7 +2843,7 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         """
         path = "changeset/{}".format(id_)
-        return wrappers["changeset"].from_xml(ET.XML(self.get(path)).find("changeset"))
+        return wrappers["changeset"].from_xml(self.get(path, parse=True).find("changeset"))
 
     def get_changeset_full(self, id_):
         """
@@ -1171,7 +2856,7 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         """
         path = "changeset/{}/download".format(id_)
-        return wrappers["osc"].from_xml(self.get(path))
+        return wrappers["osc"].from_xml(self.get(path, parse=True))
 
     def search_changeset(self, params):
         """
@@ -1185,9 +2870,8 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         """
         path = "changesets?{}".format(urlencode(params))
-        data = self.get(path)
         result = []
-        for element in ET.XML(self.get(path)).findall("changeset"):
+        for element in self.get(path, parse=True).findall("changeset"):
             result.append(wrappers["changeset"].from_xml(element))
         return result
 
@@ -1272,7 +2956,7 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         """
         path = "map?bbox={},{},{},{}".format(left, bottom, right, top)
-        return wrappers["osm"].from_xml(self.get(path))
+        return wrappers["osm"].from_xml(self.get(path, parse=True))
 
     def get_element(self, type_, id_, version=None):
         """
@@ -1297,7 +2981,7 @@ class API(BaseReadAPI, BaseWriteAPI):
             path += "/history"
         elif version is not None:
             raise TypeError("Version must be integer, '*' or None.")
-        osm = wrappers["osm"].from_xml(self.get(path))
+        osm = wrappers["osm"].from_xml(self.get(path, parse=True))
         return getattr(osm, type_ + "s")[id_]
 
     def get_element_full(self, type_, id_):
@@ -1314,7 +2998,7 @@ class API(BaseReadAPI, BaseWriteAPI):
         if type_ not in ("way", "relation"):
             raise ValueError("Type must be from {}.".format(", ".join(("way", "relation"))))
         path = "{}/{}/full".format(type_, id_)
-        return wrappers["osm"].from_xml(self.get(path))
+        return wrappers["osm"].from_xml(self.get(path, parse=True))
 
     def get_elements(self, type_, ids):
         """
@@ -1329,8 +3013,15 @@ class API(BaseReadAPI, BaseWriteAPI):
         """
         if type_ not in ("node", "way", "relation"):
             raise ValueError("Type must be 'node', 'way' or 'relation'.")
-        path = "{0}s?{0}s={1}".format(type_, ",".join((str(id) for id in ids)))
-        return wrappers["osm"].from_xml(self.get(path))
+        ids = [str(id_) for id_ in ids]
+        if len(ids) <= self.multi_fetch:
+            path = "{0}s?{0}s={1}".format(type_, ",".join(ids))
+            return wrappers["osm"].from_xml(self.get(path, parse=True))
+        osm = wrappers["osm"]()
+        for i in range(0, len(ids), self.multi_fetch):
+            for element in self.get_elements(type_, ids[i:i + self.multi_fetch]):
+                osm.add(element)
+        return osm
 
     def get_element_rels(self, type_, id_):
         """
@@ -1346,7 +3037,7 @@ class API(BaseReadAPI, BaseWriteAPI):
         if type_ not in ("node", "way", "relation"):
             raise ValueError("Type must be 'node', 'way' or 'relation'.")
         path = "{}/{}/relations".format(type_, id_)
-        return wrappers["osm"].from_xml(self.get(path))
+        return wrappers["osm"].from_xml(self.get(path, parse=True))
 
     def get_node_ways(self, element):
         """
@@ -1361,16 +3052,26 @@ class API(BaseReadAPI, BaseWriteAPI):
         if isinstance(element, Node):
             element = element.id
         path = "node/{}/ways".format(element)
-        return wrappers["osm"].from_xml(self.get(path))
+        return wrappers["osm"].from_xml(self.get(path, parse=True))
 
 
     ##################################################
     # WRITE API                                      #
     ##################################################
-    def upload_diff(self, osc, changeset=None):
+    def upload_diff(self, osc, changeset=None, chunk_size=None):
         """
         OSC diff upload.
 
+        The diff is uploaded in chunks of at most chunk_size elements, in the
+        order of OSC sections. Ids and versions returned for earlier chunks
+        replace the placeholder ids, references and versions in the later ones.
+        If changeset is None, new changesets are created as needed, so that
+        none of them exceeds changeset_maxsize or API limit of elements. The
+        next changeset is opened and the full one closed in background.
+
+        If a chunk fails, the raised APIError has partial_result attribute
+        with the result of the chunks already committed.
+
         Return {type: {old_id: returned_data} }
 
         Arguments:
@@ -1378,31 +3079,126 @@ class API(BaseReadAPI, BaseWriteAPI):
 
         Keyworded arguments:
             changeset   --- Changeset wrapper, changeset id or None (create new).
+            chunk_size  --- Maximum number of elements in one upload request.
 
         """
         if not isinstance(osc, OSC):
             raise TypeError("Osc must be OSC instance.")
-        if changeset is None and self.changeset_autocreate:
-            changeset_id = str(self.create_changeset().id)
+        auto = changeset is None and self.changeset_autocreate
+        if auto:
+            changeset_id = None
+            limit = min(self.changeset_maxsize, self._max_changeset_elements())
         else:
             changeset_id = self.get_changeset_id(changeset)
-        payload = self._format_payload(osc, changeset_id)
-        path = "changeset/{}/upload".format(changeset_id)
-        data = self.post(path, payload)
-        if changeset is None:
-            self.close_changeset(int(changeset_id))
-        data = ET.XML(data)
+            limit = self._max_changeset_elements()
+        chunk_size = min(int(chunk_size or limit), limit)
+        actions = list(osc.actions())
+        chunks = [actions[start:start+chunk_size] for start in range(0, len(actions), chunk_size)]
         result = {"node":{}, "way":{}, "relation":{}}
-        for key, value in result.items():
-            for element in data.findall(key):
-                old_id = int(element.attrib["old_id"])
-                value[old_id] = {"old_id": old_id}
-                if "new_id" in element.attrib:
-                    value[old_id]["new_id"] = int(element.attrib["new_id"])
-                if "new_version" in element.attrib:
-                    value[old_id]["new_version"] = int(element.attrib["new_version"])
+        ids = {}
+        versions = {}
+        used = 0
+        prefetched = None
+        retired = []
+        try:
+            for index, chunk in enumerate(chunks):
+                if auto and (changeset_id is None or used + len(chunk) > limit):
+                    if changeset_id is not None:
+                        retired.append(self.changesets.retire(int(changeset_id)))
+                        changeset_id = None
+                    changeset_id = str(self._next_changeset(prefetched).id)
+                    prefetched = None
+                    used = 0
+                if auto and index + 1 < len(chunks) and used + len(chunk) + len(chunks[index+1]) > limit:
+                    # Open the next changeset while uploading this chunk.
+                    prefetched = self.changesets.spawn()
+                self.log.debug("Uploading {} elements (chunk {} of {}) into changeset {}.".format(len(chunk), index+1, len(chunks), changeset_id))
+                payload, sent = self._format_chunk(chunk, changeset_id, ids, versions)
+                path = "changeset/{}/upload".format(changeset_id)
+                data = self.post(path, payload, compress=self.compress_uploads)
+                used += len(chunk)
+                for element in ET.XML(data):
+                    type_ = element.tag
+                    if type_ not in result:
+                        continue
+                    old_id = sent.get((type_, int(element.attrib["old_id"])), int(element.attrib["old_id"]))
+                    value = result[type_].setdefault(old_id, {"old_id": old_id})
+                    if "new_id" in element.attrib:
+                        value["new_id"] = int(element.attrib["new_id"])
+                        ids[(type_, old_id)] = value["new_id"]
+                    if "new_version" in element.attrib:
+                        value["new_version"] = int(element.attrib["new_version"])
+                        versions[(type_, old_id)] = value["new_version"]
+        except APIError as e:
+            e.partial_result = result
+            raise
+        finally:
+            if prefetched is not None:
+                try:
+                    retired.append(self.changesets.retire(prefetched.get()))
+                except Exception:
+                    pass
+            if auto and changeset_id is not None:
+                retired.append(self.changesets.retire(int(changeset_id)))
+            for closing in retired:
+                closing.wait()
         return result
 
+    def _next_changeset(self, prefetched=None):
+        """ Return changeset opened in background or open new one. """
+        if prefetched is not None:
+            try:
+                return prefetched.get()
+            except Exception:
+                self.log.warning("Prefetching of changeset failed, opening new one.")
+        return self.create_changeset()
+
+    def _max_changeset_elements(self):
+        """ Return maximum number of elements in changeset allowed by API. """
+        try:
+            return int(self.capabilities["changesets"]["maximum_elements"])
+        except (KeyError, TypeError, ValueError):
+            return self.changeset_maxsize
+
+    def _format_chunk(self, actions, changeset_id, ids, versions):
+        """
+        Format payload for upload of list of (action, element) tuples.
+
+        Ids, references and versions are replaced using ids and versions
+        dictionaries {(type, old_id): value}.
+
+        Return payload and dictionary {(type, sent_id): old_id}.
+
+        """
+        root = ET.Element("osmChange", {"version": str(self.version), "generator": "osmapis"})
+        section = None
+        sent = {}
+        for action, element in actions:
+            if section is None or section.tag != action:
+                section = ET.SubElement(root, action)
+            key = (element.xml_tag, element.id)
+            data = element.to_xml(strip=("user", "uid", "visible", "timestamp", "changeset"))
+            data.attrib["changeset"] = changeset_id
+            if key in ids:
+                data.attrib["id"] = str(ids[key])
+                sent[(key[0], ids[key])] = key[1]
+            if key in versions:
+                data.attrib["version"] = str(versions[key])
+            for child in data:
+                if child.tag == "nd":
+                    ref = ("node", int(child.attrib["ref"]))
+                elif child.tag == "member":
+                    ref = (child.attrib["type"], int(child.attrib["ref"]))
+                else:
+                    continue
+                if ref in ids:
+                    child.attrib["ref"] = str(ids[ref])
+            section.append(data)
+        payload = ET.tostring(root, encoding="utf-8")
+        if not isinstance(payload, str):
+            payload = payload.decode("utf-8")
+        return payload, sent
+
     def create_element(self, element, changeset=None):
         """
         Create node/way/relation.
@@ -1419,11 +3215,12 @@ class API(BaseReadAPI, BaseWriteAPI):
         if not isinstance(element, (Node, Way, Relation)):
             raise TypeError("Element must be a Node, Way or Relation instance.")
         changeset_id = self.get_changeset_id(changeset)
-        path = "{}/{}/create".format(element.xml_tag, element.id)
+        path = "{}/create".format(element.xml_tag)
         payload = "<osm>{}</osm>".format(self._format_payload(element, changeset_id))
         data = self.put(path, payload)
         self.check_auto_changeset()
-        element.attribs["version"] = int(data)
+        element.attribs["id"] = int(data)
+        element.attribs["version"] = 1
         element.attribs["changeset"] = int(changeset_id)
         element.history = {element.version: element}
         return element
@@ -1481,6 +3278,215 @@ class API(BaseReadAPI, BaseWriteAPI):
 
 
 
+class BatchSession(BaseWriteAPI):
+    """
+    Write-behind session queueing element writes and uploading them as diffs.
+
+    Queued writes of the same element are collapsed, e.g. update of
+    a queued created element stays create and delete of a queued created
+    element drops it. After upload the returned ids and versions are
+    written back into the queued wrappers, references to placeholder ids
+    of elements uploaded earlier in the session are replaced by real ids.
+
+    Usage:
+        with api.batch(flush_size=500) as batch:
+            for node in nodes:
+                node.tags["fixme"] = "check"
+                batch.update_node(node)
+
+    Attributes:
+        api             --- API instance used for uploads.
+        changeset       --- Changeset wrapper, changeset id or None (create new).
+        flush_size      --- Number of queued elements triggering upload.
+        flush_interval  --- Age in seconds of the oldest queued element triggering upload.
+        pending         --- Number of queued elements, read-only.
+
+    Methods:
+        flush           --- Upload all queued writes.
+
+    Methods (required by BaseWriteAPI):
+        upload_diff         --- OSC diff upload.
+        create_element      --- Queue creation of node/way/relation.
+        update_element      --- Queue update of node/way/relation.
+        delete_element      --- Queue deletion of node/way/relation.
+
+    """
+
+    log = logging.getLogger("osmapis.batch")
+
+    def __init__(self, api, flush_size=None, flush_interval=None, changeset=None):
+        """
+        Arguments:
+            api             --- API instance used for uploads.
+
+        Keyworded arguments:
+            flush_size      --- Number of queued elements triggering upload,
+                                changeset_maxsize of api by default.
+            flush_interval  --- Age in seconds of the oldest queued element
+                                triggering upload, None means no limit.
+            changeset       --- Changeset wrapper, changeset id or None (create new).
+
+        """
+        self.api = api
+        self.changeset = changeset
+        self.flush_size = int(flush_size or api.changeset_maxsize)
+        self.flush_interval = flush_interval
+        self._queue = OrderedDict()
+        self._since = None
+        self._renamed = {"node": {}, "way": {}, "relation": {}}
+
+    @property
+    def pending(self):
+        """ Number of queued elements """
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        elif len(self._queue) > 0:
+            self.log.warning("Discarding {} queued writes due to {}.".format(len(self._queue), exc_type.__name__))
+            self._queue.clear()
+
+    def flush(self):
+        """
+        Upload all queued writes.
+
+        If the upload fails, the writes that were not committed stay queued.
+
+        Return {type: {old_id: returned_data} }
+
+        """
+        if len(self._queue) == 0:
+            return {"node":{}, "way":{}, "relation":{}}
+        osc = wrappers["osc"]()
+        for action, element in self._queue.values():
+            self._resolve(element)
+            getattr(osc, action)(element)
+        elements = [element for action, element in self._queue.values()]
+        self.log.debug("Flushing {} queued writes.".format(len(elements)))
+        try:
+            result = self.api.upload_diff(osc, changeset=self.changeset)
+        except APIError as e:
+            if e.partial_result is not None:
+                # Keep only the writes that were not committed.
+                for type_, items in e.partial_result.items():
+                    for old_id in items:
+                        self._queue.pop((type_, old_id), None)
+                self._remember(_apply_upload_result(elements, e.partial_result, self.changeset))
+            raise
+        self._queue.clear()
+        self._since = None
+        self._remember(_apply_upload_result(elements, result, self.changeset))
+        return result
+
+    def _remember(self, renamed):
+        """ Add ids renamed by upload into the table of the session. """
+        for type_, items in renamed.items():
+            self._renamed[type_].update(items)
+
+    def _resolve(self, element):
+        """ Replace placeholder references of elements uploaded earlier in the session. """
+        if element.xml_tag == "way":
+            renamed = self._renamed["node"]
+            if renamed and element.nds and min(element.nds) < 0:
+                element.nds = [renamed.get(ref, ref) for ref in element.nds]
+        elif element.xml_tag == "relation":
+            for member in element.members:
+                if member["ref"] < 0 and member["ref"] in self._renamed[member["type"]]:
+                    member["ref"] = self._renamed[member["type"]][member["ref"]]
+
+    def _queue_element(self, action, element):
+        if not isinstance(element, (Node, Way, Relation)):
+            raise TypeError("Element must be a Node, Way or Relation instance.")
+        self._resolve(element)
+        key = (element.xml_tag, element.id)
+        queued = self._queue.get(key)
+        if queued is None:
+            self._queue[key] = (action, element)
+        elif action == "delete":
+            del self._queue[key]
+            if queued[0] != "create":
+                self._queue[key] = (action, element)
+        elif queued[0] == "delete":
+            raise ValueError("Element is already queued for deletion.")
+        else:
+            self._queue[key] = (queued[0], element)
+        if self._since is None:
+            self._since = time()
+        if len(self._queue) >= self.flush_size:
+            self.flush()
+        elif self.flush_interval is not None and time() - self._since >= self.flush_interval:
+            self.flush()
+        return element
+
+    def upload_diff(self, osc, changeset=None):
+        """
+        OSC diff upload, after flushing queued writes.
+
+        Return {type: {old_id: returned_data} }
+
+        Arguments:
+            osc         --- OSC wrapper.
+
+        Keyworded arguments:
+            changeset   --- Changeset wrapper, changeset id or None (session changeset).
+
+        """
+        self.flush()
+        if changeset is None:
+            changeset = self.changeset
+        return self.api.upload_diff(osc, changeset=changeset)
+
+    def create_element(self, element, changeset=None):
+        """
+        Queue creation of node/way/relation.
+
+        Return Node/Way/Relation wrapper, its id and version are updated on upload.
+
+        Arguments:
+            element     --- Node/Way/Relation wrapper.
+
+        Keyworded arguments:
+            changeset   --- For compatibility only, session changeset is used.
+
+        """
+        return self._queue_element("create", element)
+
+    def update_element(self, element, changeset=None):
+        """
+        Queue update of node/way/relation.
+
+        Return Node/Way/Relation wrapper, its version is updated on upload.
+
+        Arguments:
+            element     --- Node/Way/Relation wrapper.
+
+        Keyworded arguments:
+            changeset   --- For compatibility only, session changeset is used.
+
+        """
+        return self._queue_element("modify", element)
+
+    def delete_element(self, element, changeset=None):
+        """
+        Queue deletion of node/way/relation.
+
+        Return Node/Way/Relation wrapper, it's marked invisible on upload.
+
+        Arguments:
+            element     --- Node/Way/Relation wrapper.
+
+        Keyworded arguments:
+            changeset   --- For compatibility only, session changeset is used.
+
+        """
+        return self._queue_element("delete", element)
+
+
+
 ############################################################
 ### Wrappers for OSM Elements and documents.             ###
 ############################################################
@@ -1561,6 +3567,67 @@ class XMLFile(object):
             fp.write(s)
 
 
+class InternTable(object):
+    """
+    Bounded table of strings shared by wrappers created by one parser.
+
+    Parsed documents hold many equal strings - tag keys, common values,
+    roles and user names. Looking them up in the table makes all wrappers
+    reference a single copy. The table stops growing when it's full.
+
+    Attributes:
+        maxsize     --- Maximum number of stored strings.
+        max_length  --- Maximum length of stored strings.
+        hits        --- Number of lookups returning a stored string.
+        misses      --- Number of lookups of strings not stored before.
+
+    Methods:
+        intern      --- Return stored string equal to value.
+
+    """
+
+    def __init__(self, maxsize=65536, max_length=32):
+        """
+        Keyworded arguments:
+            maxsize     --- Maximum number of stored strings.
+            max_length  --- Maximum length of stored strings, longer values
+                            are rarely repeated.
+
+        """
+        self.maxsize = maxsize
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self._strings = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __repr__(self):
+        return "<InternTable size={} hits={} misses={}>".format(len(self), self.hits, self.misses)
+
+    def intern(self, value):
+        """
+        Return stored string equal to value, store the value if there is room.
+
+        Arguments:
+            value   --- String to look up.
+
+        """
+        stored = self._strings.get(value)
+        if stored is not None:
+            self.hits += 1
+            return stored
+        self.misses += 1
+        if len(self._strings) < self.maxsize and len(value) <= self.max_length:
+            self._strings[value] = value
+        return value
+
+
+def _parse_bool(value):
+    return value == "true"
+
+
 @abstractclass
 class XMLElement(object):
     """
@@ -1569,6 +3636,10 @@ class XMLElement(object):
     Abstract methods:
         to_xml          --- Get ET.Element representation of wrapper.
 
+    Class attributes:
+        attrib_types    --- Dictionary {attribute: converter} used by parse_attribs,
+                            attributes without converter are kept as strings.
+
     Class methods:
         parse_attribs   --- Extract attributes of ET.element and convert them
                             to appropriate types.
@@ -1591,23 +3662,35 @@ class XMLElement(object):
         """
         raise NotImplementedError
 
+    attrib_types = {"uid": int, "changeset": int, "version": int, "id": int, "ref": int,
+                    "lat": float, "lon": float, "min_lon": float, "max_lon": float, "min_lat": float, "max_lat": float,
+                    "open": _parse_bool, "visible": _parse_bool}
+
     @classmethod
-    def parse_attribs(cls, element):
+    def parse_attribs(cls, element, strings=None):
         """
         Extract attributes of ET.element and convert them to appropriate types.
 
+        Converters are looked up in attrib_types of the class, remove an
+        attribute from it to keep the rarely used values as strings.
+
         Arguments:
             element     --- ET.Element instance.
 
+        Keyworded arguments:
+            strings     --- InternTable for user names.
+
         """
-        attribs = dict(element.attrib)
-        for key, value in attribs.items():
-            if key in ("uid", "changeset", "version", "id", "ref"):
-                attribs[key] = int(value)
-            elif key in ("lat", "lon", "min_lon", "max_lon", "min_lat", "max_lat"):
-                attribs[key] = float(value)
-            elif key in ("open", "visible"):
-                attribs[key] = value=="true"
+        return cls._convert_attribs(element.attrib, strings)
+
+    @classmethod
+    def _convert_attribs(cls, attrib, strings=None):
+        attribs = dict(attrib)
+        for key, convert in cls.attrib_types.items():
+            if key in attribs:
+                attribs[key] = convert(attribs[key])
+        if strings is not None and "user" in attribs:
+            attribs["user"] = strings.intern(attribs["user"])
         return attribs
 
     @classmethod
@@ -1627,10 +3710,10 @@ class XMLElement(object):
         for key, value in data.items():
             if key in strip:
                 continue
-            if isinstance(value, (int, float)):
-                attribs[key] = str(value)
-            elif isinstance(value, bool):
+            if isinstance(value, bool):
                 attribs[key] = str(value).lower()
+            elif isinstance(value, (int, float)):
+                attribs[key] = str(value)
             else:
                 attribs[key] = value
         return attribs
@@ -1659,10 +3742,144 @@ class XMLElement(object):
         return res
 
 
+class _TrackedDict(dict):
+    """ Dictionary notifying its owner wrapper about modifications. """
+
+    __slots__ = ("_owner",)
+
+    def __reduce__(self):
+        return (_tracked_dict, (self._owner, dict(self)))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._owner._touch()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._owner._touch()
+
+    def clear(self):
+        dict.clear(self)
+        self._owner._touch()
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._owner._touch()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._owner._touch()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._owner._touch()
+
+
+def _tracked_dict(owner, items):
+    """ Create _TrackedDict owned by the wrapper. """
+    tracked = _TrackedDict(items)
+    tracked._owner = owner
+    return tracked
+
+
+class _TrackedList(list):
+    """ List notifying its owner wrapper about modifications. """
+
+    __slots__ = ("_owner",)
+
+    def __init__(self, owner, items=()):
+        list.__init__(self, items)
+        self._owner = owner
+
+    def __reduce__(self):
+        return (self.__class__, (self._owner, list(self)))
+
+    def _item(self, item):
+        return item
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._item(item) for item in value]
+        else:
+            value = self._item(value)
+        list.__setitem__(self, index, value)
+        self._owner._touch()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._owner._touch()
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._owner._touch()
+        return self
+
+    def append(self, item):
+        list.append(self, self._item(item))
+        self._owner._touch()
+
+    def extend(self, items):
+        list.extend(self, [self._item(item) for item in items])
+        self._owner._touch()
+
+    def insert(self, index, item):
+        list.insert(self, index, self._item(item))
+        self._owner._touch()
+
+    def pop(self, *args):
+        item = list.pop(self, *args)
+        self._owner._touch()
+        return item
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._owner._touch()
+
+    def reverse(self):
+        list.reverse(self)
+        self._owner._touch()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._owner._touch()
+
+
+class _TrackedMembers(_TrackedList):
+    """ List of relation members, each tracked as well. """
+
+    __slots__ = ()
+
+    def __init__(self, owner, items=()):
+        _TrackedList.__init__(self, owner, [_tracked_dict(owner, item) for item in items])
+
+    def _item(self, item):
+        return _tracked_dict(self._owner, item)
+
+
 class OSMElement(XMLElement):
     """
     Abstract wrapper for node, way, relation and changeset.
 
+    Modifications of attributes and tags are recorded once the wrapper is
+    tracked, see OSM.track. Until then they are held in plain containers.
+
     Class methods:
         parse_tags  --- Extract tags from ET.Element.
 
@@ -1670,6 +3887,8 @@ class OSMElement(XMLElement):
         id          --- Id of wrapper, read-only.
         attribs     --- Attributes of wrapper.
         tags        --- Tags of wrapper.
+        dirty       --- Whether the wrapper was modified since it started
+                        being tracked, read-only.
 
     Methods:
         to_xml      --- Get ET.Element representation of wrapper.
@@ -1677,29 +3896,145 @@ class OSMElement(XMLElement):
     """
 
     @classmethod
-    def parse_tags(cls, element):
+    def parse_tags(cls, element, strings=None):
         """
         Extract tags from ET.Element.
 
         Arguments:
             element     --- ET.Element instance.
 
+        Keyworded arguments:
+            strings     --- InternTable for keys and values.
+
         """
         tags = {}
-        for tag in element.findall("tag"):
-            key = tag.attrib["k"]
-            value = tag.attrib["v"]
-            tags[key] = value
+        if strings is None:
+            for tag in element.findall("tag"):
+                attrib = tag.attrib
+                tags[attrib["k"]] = attrib["v"]
+        else:
+            intern = strings.intern
+            for tag in element.findall("tag"):
+                attrib = tag.attrib
+                tags[intern(attrib["k"])] = intern(attrib["v"])
         return tags
 
+    _tracker = None
+    _dirty = False
+
     @property
     def id(self):
         """ id of wrapper """
-        return self.attribs.get("id")
+        return self._attribs.get("id")
+
+    @property
+    def attribs(self):
+        return self._attribs
+
+    @attribs.setter
+    def attribs(self, value):
+        self._attribs = self._dict(value)
+        self._touch()
+
+    @property
+    def tags(self):
+        try:
+            return self._tags
+        except AttributeError:
+            self._load()
+            return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = self._dict(value)
+        self._touch()
+
+    @property
+    def dirty(self):
+        """ whether the wrapper was modified since it started being tracked """
+        return self._dirty
 
     def __init__(self, attribs={}, tags={}):
-        self.attribs = dict(attribs)
-        self.tags = dict(tags)
+        self._attribs = dict(attribs)
+        self._tags = dict(tags)
+
+    def _dict(self, items):
+        """ Return dictionary of attributes or tags, tracked if the wrapper is. """
+        if self._tracker is None:
+            return dict(items)
+        return _tracked_dict(self, items)
+
+    def _track(self, tracker):
+        """ Report modifications to tracker, the containers become tracked. """
+        if self._tracker is None:
+            self._track_containers()
+        self._tracker = tracker
+
+    def _track_containers(self):
+        self._attribs = _tracked_dict(self, self._attribs)
+        if "_tags" in self.__dict__:
+            self._tags = _tracked_dict(self, self._tags)
+
+    def __getstate__(self):
+        if "_raw" in self.__dict__:
+            self._load()
+        state = dict(self.__dict__)
+        state.pop("_tracker", None)
+        return state
+
+    @classmethod
+    def _lazy_allowed(cls):
+        """ Check whether the class keeps default __init__, lazy wrappers bypass it. """
+        init = getattr(cls.__init__, "__func__", cls.__init__)
+        return getattr(init, "__module__", None) == __name__
+
+    @classmethod
+    def _lazy(cls, data, attribs, strings):
+        """ Create wrapper keeping raw record of ET.Element, decoded on first access. """
+        if attribs.get("id") is None:
+            # Let __init__ asign id
+            wrapper = cls(attribs)
+            for name in ("_tags", "_nds", "_members"):
+                wrapper.__dict__.pop(name, None)
+        else:
+            wrapper = cls.__new__(cls)
+            wrapper._attribs = attribs
+        record = cls._raw_record(data, strings)
+        if any(record):
+            wrapper._raw = (record, strings)
+        else:
+            # Nothing to defer
+            wrapper._decode(record, strings)
+        return wrapper
+
+    @classmethod
+    def _raw_record(cls, element, strings=None):
+        """
+        Return tuple of plain strings with tags of ET.Element, keys and values
+        alternating. The strings are interned already.
+
+        """
+        intern = strings.intern if strings is not None else lambda value: value
+        values = []
+        for tag in element.findall("tag"):
+            attrib = tag.attrib
+            values.append(intern(attrib["k"]))
+            values.append(intern(attrib["v"]))
+        return (tuple(values),)
+
+    def _load(self):
+        record, strings = self.__dict__.pop("_raw")
+        self._decode(record, strings)
+
+    def _decode(self, record, strings):
+        values = iter(record[0])
+        self._tags = self._dict(zip(values, values))
+
+    def _touch(self):
+        if not self._dirty:
+            self._dirty = True
+            if self._tracker is not None:
+                self._tracker._touched(self)
 
     def to_xml(self, strip=()):
         """
@@ -1732,7 +4067,7 @@ class OSMPrimitive(OSMElement):
     @property
     def version(self):
         """ version of node/way/relation """
-        return self.attribs.get("version")
+        return self._attribs.get("version")
 
     def __init__(self, attribs={}, tags={}):
         OSMElement.__init__(self, attribs, tags)
@@ -1740,6 +4075,14 @@ class OSMPrimitive(OSMElement):
         if self.version is not None:
             self.history[self.version] = self
 
+    @classmethod
+    def _lazy(cls, data, attribs, strings):
+        wrapper = OSMElement._lazy.__func__(cls, data, attribs, strings)
+        wrapper.history = {}
+        if wrapper.version is not None:
+            wrapper.history[wrapper.version] = wrapper
+        return wrapper
+
     def merge_history(self, other):
         if self.__class__.__name__ != other.__class__.__name__:
             raise ValueError("Cannot merge history of {} into {} wrapper.".format(other.__class__.__name__, self.__class__.__name__))
@@ -1765,6 +4108,7 @@ class Node(OSMPrimitive):
 
     Class attributes:
         xml_tag     --- XML tag of the element.
+        attrib_types --- Converters of attribute values used by parse_attribs.
 
     Class methods:
         from_xml    --- Create Node wrapper from XML representation.
@@ -1776,21 +4120,30 @@ class Node(OSMPrimitive):
     """
 
     xml_tag = "node"
+    attrib_types = {"id": int, "version": int, "changeset": int, "uid": int,
+                    "lat": float, "lon": float, "visible": _parse_bool}
     _counter = 0
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None, lazy=False):
         """
         Create Node wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Convert only attributes, keep ET.Element and decode
+                        the rest on first access.
+
         """
         if not ET.iselement(data):
             data = ET.XML(data)
-        attribs = cls.parse_attribs(data)
-        tags = cls.parse_tags(data)
+        attribs = cls.parse_attribs(data, strings)
+        if lazy and cls._lazy_allowed():
+            return cls._lazy(data, attribs, strings)
+        tags = cls.parse_tags(data, strings)
         return cls(attribs, tags)
 
     @property
@@ -1838,6 +4191,7 @@ class Way(OSMPrimitive):
 
     Class attributes:
         xml_tag     --- XML tag of the element.
+        attrib_types --- Converters of attribute values used by parse_attribs.
 
     Class methods:
         from_xml    --- Create Way wrapper from XML representation.
@@ -1852,21 +4206,29 @@ class Way(OSMPrimitive):
     """
 
     xml_tag = "way"
+    attrib_types = {"id": int, "version": int, "changeset": int, "uid": int, "visible": _parse_bool}
     _counter = 0
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None, lazy=False):
         """
         Create Way wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Convert only attributes, keep ET.Element and decode
+                        the rest on first access.
+
         """
         if not ET.iselement(data):
             data = ET.XML(data)
-        attribs = cls.parse_attribs(data)
-        tags = cls.parse_tags(data)
+        attribs = cls.parse_attribs(data, strings)
+        if lazy and cls._lazy_allowed():
+            return cls._lazy(data, attribs, strings)
+        tags = cls.parse_tags(data, strings)
         nds = cls.parse_nds(data)
         return cls(attribs, tags, nds)
 
@@ -1879,19 +4241,49 @@ class Way(OSMPrimitive):
             element     --- ET.Element instance.
 
         """
-        nds = []
-        for nd in element.findall("nd"):
-            nds.append(int(nd.attrib["ref"]))
-        return nds
+        return [int(nd.attrib["ref"]) for nd in element.findall("nd")]
+
+    @property
+    def nds(self):
+        try:
+            return self._nds
+        except AttributeError:
+            self._load()
+            return self._nds
+
+    @nds.setter
+    def nds(self, value):
+        self._nds = self._list(value)
+        self._touch()
 
     def __init__(self, attribs={}, tags={}, nds=()):
         OSMPrimitive.__init__(self, attribs, tags)
-        self.nds = list(nds)
+        self._nds = list(nds)
         if self.id is None:
             # Automatically asign id
             self.__class__._counter -= 1
             self.attribs["id"] = self.__class__._counter
 
+    @classmethod
+    def _raw_record(cls, element, strings=None):
+        """ Return tuple of plain strings with tags and node refs of ET.Element. """
+        return OSMPrimitive._raw_record.__func__(cls, element, strings) + (tuple(nd.attrib["ref"] for nd in element.findall("nd")),)
+
+    def _decode(self, record, strings):
+        OSMPrimitive._decode(self, record, strings)
+        self._nds = self._list([int(ref) for ref in record[1]])
+
+    def _list(self, items):
+        """ Return list of node ids, tracked if the wrapper is. """
+        if self._tracker is None:
+            return list(items)
+        return _TrackedList(self, items)
+
+    def _track_containers(self):
+        OSMPrimitive._track_containers(self)
+        if "_nds" in self.__dict__:
+            self._nds = _TrackedList(self, self._nds)
+
     def __eq__(self, other):
         if not isinstance(other, Way):
             return NotImplemented
@@ -1932,6 +4324,7 @@ class Relation(OSMPrimitive):
 
     Class attributes:
         xml_tag         --- XML tag of the element.
+        attrib_types    --- Converters of attribute values used by parse_attribs.
 
     Class methods:
         from_xml        --- Create Relation wrapper from XML representation.
@@ -1946,46 +4339,109 @@ class Relation(OSMPrimitive):
     """
 
     xml_tag = "relation"
+    attrib_types = {"id": int, "version": int, "changeset": int, "uid": int, "visible": _parse_bool}
     _counter = 0
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None, lazy=False):
         """
         Create Relation wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Convert only attributes, keep ET.Element and decode
+                        the rest on first access.
+
         """
         if not ET.iselement(data):
             data = ET.XML(data)
-        attribs = cls.parse_attribs(data)
-        tags = cls.parse_tags(data)
-        members = cls.parse_members(data)
+        attribs = cls.parse_attribs(data, strings)
+        if lazy and cls._lazy_allowed():
+            return cls._lazy(data, attribs, strings)
+        tags = cls.parse_tags(data, strings)
+        members = cls.parse_members(data, strings)
         return cls(attribs, tags, members)
 
     @classmethod
-    def parse_members(cls, element):
+    def parse_members(cls, element, strings=None):
         """
         Extract list of members of the relation from ET.Element.
 
         Arguments:
             element     --- ET.Element instance.
 
+        Keyworded arguments:
+            strings     --- InternTable for roles.
+
         """
         members = []
         for member in element.findall("member"):
-            members.append(cls.parse_attribs(member))
+            member = dict(member.attrib)
+            member["ref"] = int(member["ref"])
+            if strings is not None and "role" in member:
+                member["role"] = strings.intern(member["role"])
+            members.append(member)
         return members
 
+    @property
+    def members(self):
+        try:
+            return self._members
+        except AttributeError:
+            self._load()
+            return self._members
+
+    @members.setter
+    def members(self, value):
+        self._members = self._list(value)
+        self._touch()
+
     def __init__(self, attribs={}, tags={}, members=()):
         OSMPrimitive.__init__(self, attribs, tags)
-        self.members = list(members)
+        self._members = list(members)
         if self.id is None:
             # Automatically asign id
             self.__class__._counter -= 1
             self.attribs["id"] = self.__class__._counter
 
+    @classmethod
+    def _raw_record(cls, element, strings=None):
+        """ Return tuple of plain strings with tags and members of ET.Element, role None if missing. """
+        intern = strings.intern if strings is not None else lambda value: value
+        values = []
+        for member in element.findall("member"):
+            attrib = member.attrib
+            values.append(intern(attrib["type"]))
+            values.append(attrib["ref"])
+            role = attrib.get("role")
+            values.append(intern(role) if role is not None else None)
+        return OSMPrimitive._raw_record.__func__(cls, element, strings) + (tuple(values),)
+
+    def _decode(self, record, strings):
+        OSMPrimitive._decode(self, record, strings)
+        members = []
+        values = iter(record[1])
+        for type_, ref, role in zip(values, values, values):
+            member = {"type": type_, "ref": int(ref)}
+            if role is not None:
+                member["role"] = role
+            members.append(member)
+        self._members = self._list(members)
+
+    def _list(self, items):
+        """ Return list of members, tracked if the wrapper is. """
+        if self._tracker is None:
+            return list(items)
+        return _TrackedMembers(self, items)
+
+    def _track_containers(self):
+        OSMPrimitive._track_containers(self)
+        if "_members" in self.__dict__:
+            self._members = _TrackedMembers(self, self._members)
+
     def __eq__(self, other):
         if not isinstance(other, Relation):
             return NotImplemented
@@ -2025,6 +4481,7 @@ class Changeset(OSMElement):
 
     Class attributes:
         xml_tag         --- XML tag of the element.
+        attrib_types    --- Converters of attribute values used by parse_attribs.
 
     Class methods:
         from_xml        --- Create Changeset wrapper from XML representation.
@@ -2032,29 +4489,125 @@ class Changeset(OSMElement):
     """
 
     xml_tag = "changeset"
+    attrib_types = {"id": int, "uid": int, "open": _parse_bool,
+                    "min_lon": float, "max_lon": float, "min_lat": float, "max_lat": float}
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None, lazy=False):
         """
         Create Changeset wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Convert only attributes, keep ET.Element and decode
+                        the rest on first access.
+
         """
         if not ET.iselement(data):
             data = ET.XML(data)
-        attribs = cls.parse_attribs(data)
-        tags = cls.parse_tags(data)
+        attribs = cls.parse_attribs(data, strings)
+        if lazy and cls._lazy_allowed():
+            return cls._lazy(data, attribs, strings)
+        tags = cls.parse_tags(data, strings)
         return cls(attribs, tags)
 
 
-class OSM(XMLElement, XMLFile, MutableSet):
+def _apply_upload_result(elements, result, changeset=None):
     """
-    OSM XML document wrapper. Essentially a mutable set of Node, Way, Relation wrappers.
+    Update ids, references and versions of elements by result of upload_diff.
 
-    Class methods:
+    All elements are processed in a single pass, using the table of renamed
+    ids for lookup of references. Elements without placeholder references
+    are skipped without inspecting them further.
+
+    Return dictionary {type: {old_id: new_id}} of renamed ids.
+
+    """
+    if isinstance(changeset, Changeset):
+        changeset = changeset.id
+    renamed = {"node": {}, "way": {}, "relation": {}}
+    for type_, items in result.items():
+        for old_id, data in items.items():
+            new_id = data.get("new_id")
+            if new_id is not None and new_id != old_id:
+                renamed[type_][old_id] = new_id
+    renamed_nodes = renamed["node"]
+    for element in elements:
+        type_ = element.xml_tag
+        if type_ == "way":
+            if renamed_nodes and element.nds and min(element.nds) < 0:
+                element.nds = [renamed_nodes.get(ref, ref) for ref in element.nds]
+        elif type_ == "relation":
+            for member in element.members:
+                if member["ref"] < 0:
+                    member["ref"] = renamed[member["type"]].get(member["ref"], member["ref"])
+        data = result.get(type_, {}).get(element.id)
+        if data is None:
+            continue
+        if "new_id" in data:
+            element.attribs["id"] = data["new_id"]
+        else:
+            element.attribs["visible"] = False
+        if "new_version" in data:
+            element.attribs["version"] = data["new_version"]
+        if changeset is not None:
+            element.attribs["changeset"] = int(changeset)
+        element.history = {element.version: element}
+    return renamed
+
+
+def _apply_actions(target, actions):
+    """
+    Apply (action, element) tuples to target with node/way/relation, add and
+    discard methods. Changes not newer than the data in target are skipped.
+
+    Return number of applied changes.
+
+    """
+    count = 0
+    for action, element in actions:
+        current = getattr(target, element.xml_tag)(element.id)
+        if current is not None and None not in (current.version, element.version) and element.version <= current.version:
+            continue
+        if action == "delete":
+            if current is None:
+                continue
+            target.discard(element)
+        elif action in ("create", "modify"):
+            target.add(element)
+        else:
+            raise ValueError("Unexpected action {!r}.".format(action))
+        count += 1
+    return count
+
+
+def _diff_pairs(args):
+    """ Yield child elements of (parent, child) pairs that differ. """
+    pairs, trust_versions = args
+    for parent, child in pairs:
+        if trust_versions and child.version is not None and parent.version == child.version:
+            continue
+        if parent != child:
+            yield child
+
+
+def _diff_ids(args):
+    """ Return ids of child elements of (parent, child) pairs that differ. """
+    return [child.id for child in _diff_pairs(args)]
+
+
+class OSM(XMLElement, XMLFile, MutableSet):
+    """
+    OSM XML document wrapper. Essentially a mutable set of Node, Way, Relation wrappers.
+
+    Class methods:
         from_xml    --- Create OSM XML document wrapper from XML representation.
+        from_json   --- Create OSM XML document wrapper from Overpass JSON output.
+        load        --- Load the wrapper from file, optionally in parallel.
+        iterparse   --- Iterate over Node, Way, Relation wrappers in OSM XML file.
 
     Attributes:
         nodes       --- Dictionary of nodes {nodeId: Node}.
@@ -2066,34 +4619,117 @@ class OSM(XMLElement, XMLFile, MutableSet):
         node        --- Retrieve Node wrapper by id or None.
         way         --- Retrieve Way wrapper by id or None.
         relation    --- Retrieve Relation wrapper by id or None.
+        apply_upload_result --- Update ids, references and versions by result of upload_diff.
+        apply       --- Apply changes from OSC.
+        track       --- Start recording changes of the wrapper and its elements.
+        changes     --- Get OSC with changes recorded since tracking started.
 
     """
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None, lazy=False):
         """
         Create OSM XML document wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings, new one by default.
+            lazy    --- Create wrappers decoding tags, nds and members on
+                        first access.
+
         """
-        if not ET.iselement(data):
-            data = ET.XML(data)
+        if strings is None:
+            strings = InternTable()
+        if ET.iselement(data):
+            elements = (_from_xml(element, strings, lazy) for element in data if element.tag in ("node", "way", "relation"))
+        else:
+            elements = (element for parent, element in parser.elements(_text_chunks(data), 1, strings, lazy))
+        return cls._merged(elements)
+
+    @classmethod
+    def _merged(cls, elements):
+        """ Create OSM from elements, merging history of repeated ones. """
         containers = {"node": {}, "way": {}, "relation": {}}
-        for elem_type in containers.keys():
-            for element in data.findall(elem_type):
-                element = wrappers[elem_type].from_xml(element)
-                if element.id in containers[elem_type]:
-                    containers[elem_type][element.id] = containers[elem_type][element.id].merge_history(element)
-                else:
-                    containers[elem_type][element.id] = element
-        return cls(chain(containers["node"].values(), containers["way"].values(), containers["relation"].values()))
+        for element in elements:
+            container = containers[element.xml_tag]
+            id_ = element.id
+            if id_ in container:
+                container[id_] = container[id_].merge_history(element)
+            else:
+                container[id_] = element
+        if cls.add != OSM.add:
+            return cls(chain(containers["node"].values(), containers["way"].values(), containers["relation"].values()))
+        # Containers are already keyed by id, no need to add one by one
+        osm = cls()
+        osm.nodes = containers["node"]
+        osm.ways = containers["way"]
+        osm.relations = containers["relation"]
+        return osm
+
+    @classmethod
+    def from_json(cls, data, strings=None):
+        """
+        Create OSM XML document wrapper from Overpass JSON output.
+
+        Arguments:
+            data    --- JSON string or iterable of its chunks as bytes.
+
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings, new one by default.
+
+        """
+        if strings is None:
+            strings = InternTable()
+        if isinstance(data, (bytes, type(u""))):
+            data = _text_chunks(data)
+        return cls._merged(_json_elements(data, strings))
+
+    @classmethod
+    def load(cls, filename, processes=None):
+        """
+        Load the wrapper from file.
+
+        Arguments:
+            filename        --- Filename from where to load the wrapper.
+
+        Keyworded arguments:
+            processes       --- Number of worker processes parsing the file split
+                                into byte ranges, None parses in this process.
+
+        """
+        if processes is None or processes <= 1:
+            return super(OSM, cls).load(filename)
+        return cls._merged(_parallel_parse(filename, processes))
+
+    @classmethod
+    def iterparse(cls, source, strings=None, lazy=False):
+        """
+        Iterate over Node, Way, Relation wrappers in OSM XML file.
+
+        Elements are yielded in the file order and released right after that,
+        so arbitrarily large files can be processed in bounded memory.
+
+        Arguments:
+            source  --- Filename or file object with OSM XML document.
+
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings, new one by default.
+            lazy    --- Create wrappers decoding tags, nds and members on
+                        first access.
+
+        """
+        if strings is None:
+            strings = InternTable()
+        for parent, element in parser.elements(_file_chunks(source), 1, strings, lazy):
+            yield element
 
     def __init__(self, items=()):
         self.nodes = {}
         self.ways = {}
         self.relations = {}
+        self._log = None
         for item in items:
             self.add(item)
 
@@ -2114,6 +4750,11 @@ class OSM(XMLElement, XMLFile, MutableSet):
     def add(self, item):
         for container, cls in ((self.nodes, Node), (self.ways, Way), (self.relations, Relation)):
             if isinstance(item, cls):
+                if self._log is not None:
+                    key = (item.xml_tag, item.id)
+                    if key not in self._log:
+                        self._log[key] = container.get(item.id)
+                    item._track(self)
                 container[item.id] = item
                 return
         raise ValueError("Only Node, Way, Relation instances are allowed.")
@@ -2121,10 +4762,88 @@ class OSM(XMLElement, XMLFile, MutableSet):
     def discard(self, item):
         for container, cls in ((self.nodes, Node), (self.ways, Way), (self.relations, Relation)):
             if isinstance(item, cls):
+                if self._log is not None and item.id in container:
+                    key = (item.xml_tag, item.id)
+                    if key not in self._log:
+                        self._log[key] = container[item.id]
                 container.pop(item.id, None)
                 return
         raise ValueError("Only Node, Way, Relation instances are allowed.")
 
+    def _container(self, type_):
+        return getattr(self, type_ + "s")
+
+    def apply(self, osc):
+        """
+        Apply changes from OSC.
+
+        Sections are processed in order, created and modified elements
+        replace the stored ones, deleted elements are discarded. Changes
+        with version not newer than the stored element are skipped, so
+        overlapping diffs can be applied repeatedly.
+
+        Return number of applied changes.
+
+        Arguments:
+            osc     --- OSC instance or iterable of (action, element) tuples,
+                        e.g. OSC.iterparse(filename).
+
+        """
+        if isinstance(osc, OSC):
+            osc = osc.actions()
+        return _apply_actions(self, osc)
+
+    def _touched(self, element):
+        if self._log is None:
+            return
+        key = (element.xml_tag, element.id)
+        if key not in self._log and self._container(key[0]).get(key[1]) is element:
+            self._log[key] = element
+
+    def track(self):
+        """
+        Start recording changes of the wrapper and its elements.
+
+        The current content becomes the baseline of changes. Additions and
+        removals of elements and modifications of their attributes, tags,
+        nds and members are recorded as they happen, without keeping a copy
+        of the data. An element is tracked by the last OSM wrapper that
+        started tracking it. Attributes, tags, nds and members of elements
+        are replaced by tracked containers here, so references to them taken
+        before tracking started do not record changes.
+
+        """
+        self._log = {}
+        for element in self:
+            element._track(self)
+            element._dirty = False
+
+    def changes(self):
+        """
+        Get OSC with changes recorded since tracking started.
+
+        Runs in time proportional to the number of changed elements.
+
+        """
+        if self._log is None:
+            raise ValueError("Changes are not tracked, call track() first.")
+        create = []
+        modify = []
+        delete = []
+        for (type_, id_), original in self._log.items():
+            current = self._container(type_).get(id_)
+            if current is None:
+                if original is not None:
+                    delete.append(original)
+            elif original is None:
+                create.append(current)
+            elif current is not original:
+                if current != original:
+                    modify.append(current)
+            elif current.dirty:
+                modify.append(current)
+        return wrappers["osc"]._from_changes(create, modify, delete)
+
     def to_xml(self, strip=()):
         """
         Get ET.Element representation of wrapper.
@@ -2168,14 +4887,60 @@ class OSM(XMLElement, XMLFile, MutableSet):
         """
         return self.relations.get(id_)
 
+    def apply_upload_result(self, result, changeset=None):
+        """
+        Update ids, references and versions by result of upload_diff.
+
+        Elements with placeholder ids are renumbered and re-keyed, references
+        to them in ways and relations are replaced, versions are updated and
+        deleted elements are discarded.
+
+        Arguments:
+            result      --- Result of upload_diff {type: {old_id: returned_data} }.
+
+        Keyworded arguments:
+            changeset   --- Changeset wrapper or id to set to updated elements.
+
+        """
+        renamed = _apply_upload_result(self, result, changeset)
+        for type_, container in (("node", self.nodes), ("way", self.ways), ("relation", self.relations)):
+            for old_id, data in result.get(type_, {}).items():
+                if "new_id" not in data:
+                    container.pop(old_id, None)
+            for old_id, new_id in renamed[type_].items():
+                element = container.pop(old_id, None)
+                if element is not None:
+                    container[new_id] = element
+            if self._log is not None:
+                # Uploaded changes become part of the baseline
+                for old_id, data in result.get(type_, {}).items():
+                    self._log.pop((type_, old_id), None)
+                    element = container.get(data.get("new_id"))
+                    if element is not None:
+                        self._log.pop((type_, element.id), None)
+                        element._dirty = False
+
 
 class OSC(XMLElement, XMLFile):
     """
     OSC XML document wrapper.
 
+    Changes are kept in a compact log - elements appended to per-action lists
+    and runs of the same action. Elements are output in the order accepted by
+    the API: nodes, ways, relations in create and modify sections and the
+    reverse in delete sections. When no element goes back from delete to
+    modify or from modify to create, the runs are coalesced into at most one
+    create, modify and delete section.
+
+    Once sections attribute is accessed, the log is materialized into it and
+    the sections become the source of truth, so they can be modified in place.
+
     Class methods:
         from_diff   --- Create OSC XML document wrapper by diffing two OSM instances.
+        from_sorted --- Create OSC XML document wrapper by diffing two sorted streams of elements.
+        merge       --- Merge OSC instances into one with the minimal changes.
         from_xml    --- Create OSC XML document wrapper from XML representation.
+        iterparse   --- Iterate over (action, element) tuples in OSC XML file.
 
     Attributes:
         sections    --- List of tuples (action, OSM instance), where action is
@@ -2183,6 +4948,9 @@ class OSC(XMLElement, XMLFile):
 
     Methods:
         to_xml      --- Get ET.Element representation of wrapper.
+        actions     --- Iterate over (action, element) tuples in order of sections.
+        simplify    --- Collapse repeated changes of elements.
+        apply_upload_result --- Update ids, references and versions by result of upload_diff.
         create      --- Add new create section (unless the last one is create)
                         and add to it the specified element.
         modify      --- Add new modify section (unless the last one is modify)
@@ -2193,7 +4961,7 @@ class OSC(XMLElement, XMLFile):
     """
 
     @classmethod
-    def from_diff(cls, parent, child):
+    def from_diff(cls, parent, child, trust_versions=False, processes=None):
         """
         Create OSC XML document wrapper by diffing two OSM instances.
 
@@ -2201,22 +4969,132 @@ class OSC(XMLElement, XMLFile):
             parent  --- OSM instance with original data.
             child   --- OSM instance with changed data.
 
+        Keyworded arguments:
+            trust_versions --- Consider elements with equal versions unchanged
+                            without comparing their content.
+            processes   --- Number of worker processes comparing elements split
+                            by id range, None compares in this process.
+
         """
         if not (isinstance(parent, OSM) and isinstance(child, OSM)):
             raise TypeError("Both arguments must be OSM instances.")
-        create = set()
-        modify = set()
-        delete = set()
-        for type_ in ("node", "way", "relation"):
-            parent_elements = getattr(parent, type_ + "s")
-            child_elements = getattr(child, type_ + "s")
-            for id_ in set(child_elements.keys()) | set(parent_elements.keys()):
-                if id_ not in child_elements:
-                    delete.add(parent_elements[id_])
-                elif id_ not in parent_elements:
-                    create.add(child_elements[id_])
-                elif parent_elements[id_] != child_elements[id_]:
-                    modify.add(child_elements[id_])
+        create = []
+        modify = []
+        delete = []
+        pool = None
+        if processes is not None and processes > 1:
+            pool = multiprocessing.Pool(processes)
+        try:
+            for type_ in ("node", "way", "relation"):
+                parent_elements = getattr(parent, type_ + "s")
+                child_elements = getattr(child, type_ + "s")
+                parent_ids = set(parent_elements)
+                child_ids = set(child_elements)
+                delete.extend(parent_elements[id_] for id_ in sorted(parent_ids - child_ids))
+                create.extend(child_elements[id_] for id_ in sorted(child_ids - parent_ids))
+                pairs = [(parent_elements[id_], child_elements[id_]) for id_ in sorted(parent_ids & child_ids)]
+                if pool is None:
+                    modify.extend(_diff_pairs((pairs, trust_versions)))
+                else:
+                    size = max(1, -(-len(pairs) // (processes * 4)))
+                    chunks = [(pairs[i:i + size], trust_versions) for i in range(0, len(pairs), size)]
+                    for ids in pool.map(_diff_ids, chunks):
+                        modify.extend(child_elements[id_] for id_ in ids)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return cls._from_changes(create, modify, delete)
+
+    @classmethod
+    def from_sorted(cls, parent, child, trust_versions=False):
+        """
+        Create OSC XML document wrapper by diffing two sorted streams of elements.
+
+        Both streams must be ordered like OSM files - nodes, ways, relations,
+        each by id. Only the elements being compared and the resulting changes
+        are kept in memory.
+
+        Arguments:
+            parent  --- Iterable of Node, Way, Relation wrappers with original data.
+            child   --- Iterable of Node, Way, Relation wrappers with changed data.
+
+        Keyworded arguments:
+            trust_versions --- Consider elements with equal versions unchanged
+                            without comparing their content.
+
+        """
+        order = {"node": 0, "way": 1, "relation": 2}
+        def keyed(elements):
+            last = None
+            for element in elements:
+                key = (order[element.xml_tag], element.id)
+                if last is not None and key <= last:
+                    raise ValueError("Elements must be sorted by type and id, got {} {} after {} {}.".format(element.xml_tag, element.id, ("node", "way", "relation")[last[0]], last[1]))
+                last = key
+                yield key, element
+        create = []
+        modify = []
+        delete = []
+        parent = keyed(parent)
+        child = keyed(child)
+        old = next(parent, None)
+        new = next(child, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                delete.append(old[1])
+                old = next(parent, None)
+            elif old is None or new[0] < old[0]:
+                create.append(new[1])
+                new = next(child, None)
+            else:
+                modify.extend(_diff_pairs(([(old[1], new[1])], trust_versions)))
+                old = next(parent, None)
+                new = next(child, None)
+        return cls._from_changes(create, modify, delete)
+
+    @classmethod
+    def merge(cls, *oscs):
+        """
+        Merge OSC instances into one with the minimal changes.
+
+        Changes of every element are collapsed in one pass - create followed
+        by modifications is create of the last state, create followed by
+        delete is dropped, modifications keep the last state and anything
+        followed by delete is delete.
+
+        Arguments:
+            *oscs   --- OSC instances or iterables of (action, element) tuples
+                        in the order they should be applied.
+
+        """
+        first = {}
+        last = {}
+        for osc in oscs:
+            if isinstance(osc, OSC):
+                osc = osc.actions()
+            for action, element in osc:
+                if action not in ("create", "modify", "delete"):
+                    raise ValueError("Unexpected action {!r}.".format(action))
+                key = (element.xml_tag, element.id)
+                if key not in first:
+                    first[key] = action
+                last[key] = (action, element)
+        create = []
+        modify = []
+        delete = []
+        for key, (action, element) in last.items():
+            if first[key] == "create":
+                if action != "delete":
+                    create.append(element)
+            elif action == "delete":
+                delete.append(element)
+            else:
+                modify.append(element)
+        return cls._from_changes(create, modify, delete)
+
+    @classmethod
+    def _from_changes(cls, create, modify, delete):
         sections = []
         if len(create) > 0:
             sections.append(("create", create))
@@ -2227,19 +5105,28 @@ class OSC(XMLElement, XMLFile):
         return cls(*sections)
 
     @classmethod
-    def from_xml(cls, data):
+    def from_xml(cls, data, strings=None):
         """
         Create OSM XML document wrapper from XML representation.
 
         Arguments:
             data    --- ET.Element or XML string.
 
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings, new one by default.
+
         """
+        if strings is None:
+            strings = InternTable()
         if not ET.iselement(data):
-            data = ET.XML(data)
+            elements = parser.elements(_text_chunks(data), 2, strings)
+            sections = []
+            for action, group in groupby(elements, itemgetter(0)):
+                sections.append((action, wrappers["osm"]._merged(element for action, element in group)))
+            return cls(*sections)
         sections = []
         for section in data:
-            sections.append((section.tag, wrappers["osm"].from_xml(section)))
+            sections.append((section.tag, _from_xml(section, strings, name="osm")))
         return cls(*sections)
 
     def __init__(self, *sections):
@@ -2248,12 +5135,76 @@ class OSC(XMLElement, XMLFile):
             *sections   --- Arbitrary number of tuples (action, elements).
 
         """
-        self.sections = []
+        self.sections = sections
+
+    @property
+    def sections(self):
+        if self._sections is None:
+            self._sections = [(action, wrappers["osm"](elements)) for action, elements in self._iter_runs()]
+            self._changes = None
+            self._runs = None
+        return self._sections
+
+    @sections.setter
+    def sections(self, sections):
+        self._changes = {"create": [], "modify": [], "delete": []}
+        self._runs = []
+        self._sections = None
         for section in sections:
             action, elements = tuple(section)
             if action not in ("create", "modify", "delete"):
                 raise ValueError("Unexpected action {!r}.".format(action))
-            self.sections.append((action, wrappers["osm"](elements)))
+            for element in elements:
+                self._append(action, element)
+
+    def _append(self, action, element):
+        if not isinstance(element, (Node, Way, Relation)):
+            raise ValueError("Only Node, Way, Relation instances are allowed.")
+        if self._sections is not None:
+            if len(self._sections) > 0 and self._sections[-1][0] == action:
+                self._sections[-1][1].add(element)
+            else:
+                self._sections.append((action, wrappers["osm"]([element])))
+            return
+        self._changes[action].append(element)
+        if len(self._runs) > 0 and self._runs[-1][0] == action:
+            self._runs[-1][1] += 1
+        else:
+            self._runs.append([action, 1])
+
+    def _coalescable(self, runs, ranks):
+        """ Check that no element goes back from delete to modify or from modify to create. """
+        last = {}
+        for action, elements in runs:
+            rank = ranks[action]
+            for element in elements:
+                key = (element.xml_tag, element.id)
+                if last.get(key, rank) > rank:
+                    return False
+                last[key] = rank
+        return True
+
+    def _iter_runs(self):
+        """ Yield (action, elements) of sections in the order for API. """
+        if self._sections is not None:
+            for action, osm in self._sections:
+                containers = (osm.relations, osm.ways, osm.nodes) if action == "delete" else (osm.nodes, osm.ways, osm.relations)
+                yield action, [element for container in containers for element in container.values()]
+            return
+        ranks = {"create": 0, "modify": 1, "delete": 2}
+        runs = []
+        offsets = {"create": 0, "modify": 0, "delete": 0}
+        for action, count in self._runs:
+            runs.append((action, self._changes[action][offsets[action]:offsets[action] + count]))
+            offsets[action] += count
+        if any(ranks[runs[i][0]] >= ranks[runs[i + 1][0]] for i in range(len(runs) - 1)) and self._coalescable(runs, ranks):
+            runs = [(action, self._changes[action]) for action in ("create", "modify", "delete") if len(self._changes[action]) > 0]
+        for action, elements in runs:
+            containers = {"node": {}, "way": {}, "relation": {}}
+            for element in elements:
+                containers[element.xml_tag][element.id] = element
+            types = ("relation", "way", "node") if action == "delete" else ("node", "way", "relation")
+            yield action, [element for type_ in types for element in containers[type_].values()]
 
     def to_xml(self, strip=()):
         """
@@ -2264,14 +5215,69 @@ class OSC(XMLElement, XMLFile):
 
         """
         element = ET.Element("osmChange", {"version": str(API.version), "generator": "osmapis"})
-        for action, container in self.sections:
-            section = container.to_xml(strip=strip)
-            if len(section) > 0:
-                section.tag = action
-                section.attrib = {}
-                element.append(section)
+        for action, elements in self._iter_runs():
+            section = ET.SubElement(element, action)
+            for child in elements:
+                section.append(child.to_xml(strip=strip))
         return element
 
+    @classmethod
+    def iterparse(cls, source, strings=None):
+        """
+        Iterate over (action, element) tuples in OSC XML file.
+
+        Elements are yielded in the file order and released right after that,
+        so arbitrarily large files can be processed in bounded memory.
+
+        Arguments:
+            source  --- Filename or file object with OSC XML document.
+
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings, new one by default.
+
+        """
+        if strings is None:
+            strings = InternTable()
+        for action, element in parser.elements(_file_chunks(source), 2, strings):
+            yield action, element
+
+    def actions(self):
+        """
+        Iterate over (action, element) tuples in order of sections.
+
+        """
+        for action, elements in self._iter_runs():
+            for element in elements:
+                yield action, element
+
+    def simplify(self):
+        """
+        Collapse repeated changes of elements, see OSC.merge.
+
+        """
+        self.sections = self.merge(self).sections
+
+    def apply_upload_result(self, result, changeset=None):
+        """
+        Update ids, references and versions by result of upload_diff.
+
+        Elements with placeholder ids are renumbered, references to them in
+        ways and relations are replaced, versions are updated and deleted
+        elements are marked invisible.
+
+        Arguments:
+            result      --- Result of upload_diff {type: {old_id: returned_data} }.
+
+        Keyworded arguments:
+            changeset   --- Changeset wrapper or id to set to updated elements.
+
+        """
+        elements = dict((id(element), element) for action, element in self.actions())
+        _apply_upload_result(elements.values(), result, changeset)
+        if self._sections is not None:
+            # Containers are keyed by the old ids.
+            self._sections = [(action, wrappers["osm"](list(osm))) for action, osm in self._sections]
+
     def create(self, element):
         """
         Add new create section (unless the last one is create) and add to it
@@ -2281,9 +5287,7 @@ class OSC(XMLElement, XMLFile):
             element     --- OSM element wrapper to create.
 
         """
-        if len(self.sections) == 0 or self.sections[-1][0] != "create":
-            self.sections.append(("create", wrappers["osm"]()))
-        self.sections[-1][1].add(element)
+        self._append("create", element)
 
     def modify(self, element):
         """
@@ -2294,9 +5298,7 @@ class OSC(XMLElement, XMLFile):
             element     --- OSM element wrapper to modify.
 
         """
-        if len(self.sections) == 0 or self.sections[-1][0] != "modify":
-            self.sections.append(("modify", wrappers["osm"]()))
-        self.sections[-1][1].add(element)
+        self._append("modify", element)
 
     def delete(self, element):
         """
@@ -2307,9 +5309,7 @@ class OSC(XMLElement, XMLFile):
             element     --- OSM element wrapper to delete.
 
         """
-        if len(self.sections) == 0 or self.sections[-1][0] != "delete":
-            self.sections.append(("delete", wrappers["osm"]()))
-        self.sections[-1][1].add(element)
+        self._append("delete", element)
 
 
 """
@@ -2318,10 +5318,1569 @@ Dictionary containing the classes to use for OSM element wrappers.
 This is the place, where you can set customized wrapper classes.
 WARNING: Customized classes should always inherit from the default ones,
          otherwise BAD things will happen!
+Classes with customized __init__ are always fully decoded, lazy wrappers
+are created only for classes keeping the default one.
 """
 wrappers = {"node": Node, "way": Way, "relation": Relation,
             "changeset": Changeset, "osm": OSM, "osc": OSC}
 
+_from_xml_arguments = {}
+
+
+def _accepts_strings(cls):
+    """ Check whether from_xml of class accepts strings and lazy arguments. """
+    method = getattr(cls.from_xml, "__func__", cls.from_xml)
+    result = _from_xml_arguments.get(method)
+    if result is None:
+        try:
+            spec = inspect.getfullargspec(method)
+        except AttributeError:
+            # Python 2.x compatibility
+            spec = inspect.getargspec(method)
+        result = spec.varargs is not None or len(spec.args) >= 4
+        _from_xml_arguments[method] = result
+    return result
+
+
+def _from_xml(element, strings=None, lazy=False, name=None):
+    """
+    Create wrapper of ET.Element using the class from wrappers.
+
+    Customized classes overriding from_xml with the old signature get only
+    the element. Name of the wrapper is the tag of element by default.
+
+    """
+    cls = wrappers[name or element.tag]
+    if _accepts_strings(cls):
+        return cls.from_xml(element, strings, lazy)
+    return cls.from_xml(element)
+
+
+
+############################################################
+### XML parser backends.                                 ###
+############################################################
+
+def _text_chunks(data, size=65536):
+    """ Yield XML or JSON string as chunks of bytes. """
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def _file_chunks(source, size=65536):
+    """ Yield chunks of bytes read from filename or file object. """
+    if hasattr(source, "read"):
+        for chunk in iter(lambda: source.read(size), b""):
+            yield chunk
+    else:
+        with open(source, "rb") as fp:
+            for chunk in iter(lambda: fp.read(size), b""):
+                yield chunk
+
+
+class ElementTreeParser(object):
+    """
+    Parser backend using xml.etree.ElementTree.
+
+    Elements are parsed into ET.Element, converted to wrappers and released.
+
+    Methods:
+        elements    --- Iterate over (parent tag, wrapper) of XML document.
+
+    """
+
+    name = "etree"
+
+    def _events(self, chunks):
+        if not hasattr(ET, "XMLPullParser"):
+            # Python 2.x compatibility
+            source = io.BytesIO(b"".join(chunks))
+            for event in ET.iterparse(source, events=("start", "end")):
+                yield event
+            return
+        parser = ET.XMLPullParser(events=("start", "end"))
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+
+    def elements(self, chunks, depth, strings=None, lazy=False):
+        """
+        Iterate over (parent tag, wrapper) of XML document.
+
+        Yields wrappers of nodes, ways and relations at the given depth with
+        the tag of their parent element.
+
+        Arguments:
+            chunks  --- Iterable of bytes chunks of the document.
+            depth   --- Depth of the elements, 1 in OSM, 2 in OSC documents.
+
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Create wrappers decoding tags, nds and members on
+                        first access.
+
+        """
+        stack = []
+        for event, element in self._events(chunks):
+            if event == "start":
+                stack.append(element)
+                continue
+            stack.pop()
+            if 0 < len(stack) <= depth:
+                if len(stack) == depth and element.tag in ("node", "way", "relation"):
+                    wrapper = _from_xml(element, strings, lazy)
+                    # Lazy wrappers keep only raw record, not the subtree
+                    element.clear()
+                    yield stack[-1].tag, wrapper
+                stack[-1].clear()
+
+
+class LxmlParser(ElementTreeParser):
+    """
+    Parser backend using lxml, available only when lxml is installed.
+
+    Methods:
+        elements    --- Iterate over (parent tag, wrapper) of XML document.
+
+    """
+
+    name = "lxml"
+
+    def __init__(self):
+        if lxml_etree is None:
+            raise ImportError("lxml is not installed.")
+
+    def _events(self, chunks):
+        parser = lxml_etree.XMLPullParser(events=("start", "end"), huge_tree=True)
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+
+
+class _ExpatHandler(object):
+    """ Expat callbacks collecting wrappers at given depth. """
+
+    def __init__(self, depth, strings):
+        self.depth = depth
+        self.intern = strings.intern if strings is not None else lambda value: value
+        self.strings = strings
+        self.stack = []
+        self.current = None
+        self.element = None
+        self.result = []
+
+    def start(self, name, attrs):
+        level = len(self.stack)
+        self.stack.append(name)
+        if level == self.depth:
+            if name in ("node", "way", "relation"):
+                if _accepts_strings(wrappers[name]):
+                    self.current = (name, wrappers[name]._convert_attribs(attrs, self.strings), {}, [])
+                else:
+                    # Customized from_xml with the old signature needs ET.Element.
+                    self.element = ET.Element(name, attrs)
+        elif level == self.depth + 1 and self.element is not None:
+            ET.SubElement(self.element, name, attrs)
+        elif level == self.depth + 1 and self.current is not None:
+            intern = self.intern
+            if name == "tag":
+                self.current[2][intern(attrs["k"])] = intern(attrs["v"])
+            elif name == "nd":
+                self.current[3].append(int(attrs["ref"]))
+            elif name == "member":
+                attrs["ref"] = int(attrs["ref"])
+                if "role" in attrs:
+                    attrs["role"] = intern(attrs["role"])
+                self.current[3].append(attrs)
+
+    def end(self, name):
+        self.stack.pop()
+        if len(self.stack) == self.depth and self.element is not None:
+            self.result.append((self.stack[-1], wrappers[name].from_xml(self.element)))
+            self.element = None
+        elif len(self.stack) == self.depth and self.current is not None:
+            name, attribs, tags, children = self.current
+            if name == "node":
+                element = wrappers[name](attribs, tags)
+            else:
+                element = wrappers[name](attribs, tags, children)
+            self.result.append((self.stack[-1], element))
+            self.current = None
+
+
+class ExpatParser(object):
+    """
+    Parser backend creating wrappers directly from expat callbacks, without
+    building any intermediate tree. Lazy wrappers are not supported, the
+    wrappers are always fully decoded.
+
+    Methods:
+        elements    --- Iterate over (parent tag, wrapper) of XML document.
+
+    """
+
+    name = "expat"
+
+    def elements(self, chunks, depth, strings=None, lazy=False):
+        """
+        Iterate over (parent tag, wrapper) of XML document.
+
+        Yields wrappers of nodes, ways and relations at the given depth with
+        the tag of their parent element.
+
+        Arguments:
+            chunks  --- Iterable of bytes chunks of the document.
+            depth   --- Depth of the elements, 1 in OSM, 2 in OSC documents.
+
+        Keyworded arguments:
+            strings --- InternTable deduplicating strings.
+            lazy    --- Ignored.
+
+        """
+        handler = _ExpatHandler(depth, strings)
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = handler.start
+        parser.EndElementHandler = handler.end
+        for chunk in chain(chunks, [None]):
+            if chunk is None:
+                parser.Parse(b"", True)
+            else:
+                parser.Parse(chunk, False)
+            for item in handler.result:
+                yield item
+            del handler.result[:]
+
+
+"""
+Dictionary of available parser backends.
+"""
+parsers = {"etree": ElementTreeParser, "expat": ExpatParser}
+if lxml_etree is not None:
+    parsers["lxml"] = LxmlParser
+
+"""
+Parser backend used for XML strings and files.
+
+Set it to instance of another backend from parsers to change it.
+"""
+parser = ElementTreeParser()
+
+
+_element_starts = (b"<node", b"<way", b"<relation")
+try:
+    array("q")
+    _int64_code = "q"
+except ValueError:
+    # Python 2.x compatibility
+    _int64_code = "l"
+
+
+def _next_boundary(fp, offset, end, size=65536):
+    """ Return offset of the first node/way/relation start tag at or after offset, or end. """
+    overlap = max(len(start) for start in _element_starts)
+    while offset < end:
+        fp.seek(offset)
+        block = fp.read(min(size, end - offset) + overlap + 1)
+        found = None
+        for start in _element_starts:
+            index = block.find(start)
+            while index >= 0:
+                following = block[index + len(start):index + len(start) + 1]
+                if following in (b" ", b"\t", b"\r", b"\n", b">", b"/"):
+                    break
+                index = block.find(start, index + 1)
+            if index >= 0 and (found is None or index < found):
+                found = index
+        if found is not None:
+            return min(offset + found, end)
+        offset += size
+    return end
+
+
+def _split_osm_file(filename, pieces):
+    """ Split OSM XML file at element boundaries into list of (start, end) byte ranges. """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as fp:
+        tail = max(0, size - 4096)
+        fp.seek(tail)
+        end = fp.read().rfind(b"</osm")
+        if end < 0:
+            raise ValueError("File {!r} is not OSM XML document.".format(filename))
+        end += tail
+        start = _next_boundary(fp, 0, end)
+        offsets = [start]
+        for i in range(1, pieces):
+            offsets.append(_next_boundary(fp, max(offsets[-1], start + (end - start) * i // pieces), end))
+        offsets.append(end)
+    return [(a, b) for a, b in zip(offsets, offsets[1:]) if a < b]
+
+
+class _ColumnHandler(object):
+    """ Expat callbacks collecting elements into compact columns per type. """
+
+    def __init__(self):
+        self.strings = InternTable()
+        self.columns = {}
+        self.current = None
+        self.depth = 0
+
+    def _type_columns(self, name):
+        if name not in self.columns:
+            self.columns[name] = {"count": 0, "attribs": {}, "tags": [], "tag_counts": array("l"),
+                                  "refs": array(_int64_code), "ref_counts": array("l"), "types": [], "roles": []}
+        return self.columns[name]
+
+    def start(self, name, attrs):
+        self.depth += 1
+        intern = self.strings.intern
+        if self.depth == 2 and name in ("node", "way", "relation"):
+            columns = self._type_columns(name)
+            attribs = wrappers[name]._convert_attribs(attrs, self.strings)
+            for key, value in attribs.items():
+                column = columns["attribs"].get(key)
+                if column is None:
+                    column = columns["attribs"][key] = [None] * columns["count"]
+                column.append(value)
+            columns["count"] += 1
+            for column in columns["attribs"].values():
+                if len(column) < columns["count"]:
+                    column.append(None)
+            columns["tag_counts"].append(0)
+            columns["ref_counts"].append(0)
+            self.current = columns
+        elif self.depth == 3 and self.current is not None:
+            columns = self.current
+            if name == "tag":
+                columns["tags"].append(intern(attrs["k"]))
+                columns["tags"].append(intern(attrs["v"]))
+                columns["tag_counts"][-1] += 1
+            elif name in ("nd", "member"):
+                columns["refs"].append(int(attrs["ref"]))
+                columns["ref_counts"][-1] += 1
+                if name == "member":
+                    columns["types"].append(intern(attrs["type"]))
+                    columns["roles"].append(intern(attrs["role"]) if "role" in attrs else None)
+
+    def end(self, name):
+        if self.depth == 2:
+            self.current = None
+        self.depth -= 1
+
+    def result(self):
+        """ Return columns with numeric attributes packed into arrays. """
+        for columns in self.columns.values():
+            for key, column in columns["attribs"].items():
+                if None in column:
+                    continue
+                if all(type(value) is int for value in column):
+                    columns["attribs"][key] = array(_int64_code, column)
+                elif all(type(value) is float for value in column):
+                    columns["attribs"][key] = array("d", column)
+        return self.columns
+
+
+def _parse_columns(args):
+    """ Parse byte range of OSM XML file into compact columns per element type. """
+    filename, start, end = args
+    with open(filename, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    handler = _ColumnHandler()
+    xml_parser = expat.ParserCreate("utf-8")
+    xml_parser.StartElementHandler = handler.start
+    xml_parser.EndElementHandler = handler.end
+    xml_parser.Parse(b"<osm>", False)
+    xml_parser.Parse(data, False)
+    xml_parser.Parse(b"</osm>", True)
+    return handler.result()
+
+
+def _column_elements(name, columns):
+    """
+    Yield wrappers of one element type from columns created by _ColumnHandler.
+
+    Strings were interned by the worker and stay shared after unpickling.
+    Classes keeping the default __init__ get their wrappers assembled
+    directly, like lazy wrappers.
+
+    """
+    cls = wrappers[name]
+    direct = cls._lazy_allowed()
+    new = cls.__new__
+    keys = list(columns["attribs"].keys())
+    rows = zip(*columns["attribs"].values())
+    tags = columns["tags"]
+    refs = columns["refs"]
+    types = columns["types"]
+    roles = columns["roles"]
+    tag_offset = 0
+    ref_offset = 0
+    for row, tag_count, ref_count in zip(rows, columns["tag_counts"], columns["ref_counts"]):
+        attribs = dict(zip(keys, row))
+        if None in row:
+            attribs = dict((key, value) for key, value in attribs.items() if value is not None)
+        tag_end = tag_offset + 2 * tag_count
+        element_tags = dict(zip(tags[tag_offset:tag_end:2], tags[tag_offset + 1:tag_end:2]))
+        tag_offset = tag_end
+        ref_end = ref_offset + ref_count
+        if name == "node":
+            children = None
+        elif name == "way":
+            children = refs[ref_offset:ref_end].tolist()
+        else:
+            children = []
+            for j in range(ref_offset, ref_end):
+                member = {"type": types[j], "ref": refs[j]}
+                if roles[j] is not None:
+                    member["role"] = roles[j]
+                children.append(member)
+        ref_offset = ref_end
+        if not direct or attribs.get("id") is None:
+            yield cls(attribs, element_tags) if children is None else cls(attribs, element_tags, children)
+            continue
+        wrapper = new(cls)
+        wrapper._attribs = attribs
+        wrapper._tags = element_tags
+        if name == "way":
+            wrapper._nds = children
+        elif name == "relation":
+            wrapper._members = children
+        version = attribs.get("version")
+        wrapper.history = {version: wrapper} if version is not None else {}
+        yield wrapper
+
+
+def _parse_records(args):
+    """
+    Parse byte range of OSM XML file into list of (type, id, pickled wrapper),
+    pickled as shelve does it.
+
+    """
+    columns = _parse_columns(args)
+    records = []
+    for name in ("node", "way", "relation"):
+        if name in columns:
+            for element in _column_elements(name, columns[name]):
+                records.append((name, element.id, pickle.dumps(element, 2)))
+    return records
+
+
+def _parallel_map(func, filename, processes):
+    """ Iterate over results of func for byte ranges of OSM XML file in pool of worker processes. """
+    ranges = _split_osm_file(filename, processes * 4)
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = [(filename, start, end) for start, end in ranges]
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parallel_parse(filename, processes):
+    """ Iterate over wrappers of OSM XML file parsed by pool of worker processes. """
+    for result in _parallel_map(_parse_columns, filename, processes):
+        for name in ("node", "way", "relation"):
+            if name in result:
+                for element in _column_elements(name, result[name]):
+                    yield element
+
+
+_json_elements_start = re.compile(r'"elements"\s*:\s*\[')
+_json_separator = re.compile(r'[\s,]*')
+_json_remark = re.compile(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")')
+_xml_remark = re.compile(br"<remark>(.*?)</remark>", re.S)
+_overpass_split_error = re.compile(r"runtime error:.*(timed out|out of memory)")
+
+
+def _xml_remarks(chunks, remarks):
+    """ Yield chunks of Overpass XML output, collect texts of remark elements. """
+    buffer = b""
+    for chunk in chunks:
+        yield chunk
+        buffer += chunk
+        while True:
+            start = buffer.find(b"<remark")
+            if start < 0:
+                buffer = buffer[-len(b"<remark"):]
+                break
+            match = _xml_remark.search(buffer, start)
+            if match is None:
+                buffer = buffer[start:]
+                break
+            remarks.append(_unescape_xml(match.group(1).decode("utf-8")).strip())
+            buffer = buffer[match.end():]
+
+
+def _unescape_xml(text):
+    """ Replace predefined XML entities in text. """
+    for entity, char in (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&apos;", "'"), ("&amp;", "&")):
+        text = text.replace(entity, char)
+    return text
+
+
+def _json_query(query):
+    """ Request Overpass JSON output of XML or QL query. """
+    query = query.strip()
+    if query.startswith("<?xml"):
+        query = query.split("?>", 1)[1].strip()
+    if query.startswith("<osm-script"):
+        return '<osm-script output="json"' + query[len("<osm-script"):]
+    if query.startswith("<"):
+        return '<osm-script output="json">{}</osm-script>'.format(query)
+    if query.startswith("["):
+        return "[out:json]" + query
+    return "[out:json];" + query
+
+
+def _iter_json_elements(chunks, remarks=None):
+    """
+    Yield items of elements array of Overpass JSON output.
+
+    Every item is decoded by C JSON scanner as soon as it is complete, so the
+    whole document is never held in memory.
+
+    Keyworded arguments:
+        remarks     --- List to append remarks of the document to, the rest
+                        of the document is read after the elements then.
+
+    """
+    scanner = json.JSONDecoder()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = u""
+    position = None
+    finished = False
+    source = chain(chunks, [None])
+    for chunk in source:
+        buffer += decoder.decode(chunk or b"", chunk is None)
+        if position is None:
+            match = _json_elements_start.search(buffer)
+            if match is None:
+                continue
+            position = match.end()
+            if remarks is not None:
+                remarks.extend(json.loads(value) for value in _json_remark.findall(buffer, 0, match.start()))
+        while True:
+            position = _json_separator.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == "]":
+                finished = True
+                break
+            try:
+                item, position = scanner.raw_decode(buffer, position)
+            except ValueError:
+                if chunk is None:
+                    raise
+                break
+            yield item
+        if finished:
+            break
+        buffer = buffer[position:]
+        position = 0
+    if not finished:
+        raise ValueError("Incomplete elements array in JSON document.")
+    if remarks is not None:
+        rest = buffer[position:]
+        for chunk in source:
+            rest += decoder.decode(chunk or b"", chunk is None)
+        remarks.extend(json.loads(value) for value in _json_remark.findall(rest))
+
+
+def _json_elements(chunks, strings=None, remarks=None):
+    """
+    Yield Node, Way, Relation wrappers from chunks of Overpass JSON output.
+
+    Other items, e.g. areas or counts, are skipped.
+
+    """
+    for item in _iter_json_elements(chunks, remarks):
+        if item.get("type") in ("node", "way", "relation"):
+            yield _json_wrapper(item, strings)
+
+
+def _json_wrapper(item, strings=None):
+    """ Create Node, Way, Relation wrapper from item of Overpass JSON output. """
+    attribs = dict(item)
+    cls = wrappers[attribs.pop("type")]
+    tags = attribs.pop("tags", {})
+    children = attribs.pop("nodes", None) or attribs.pop("members", None) or []
+    for key in ("geometry", "bounds", "center"):
+        # Child elements in XML output, not attributes
+        attribs.pop(key, None)
+    if cls is wrappers["relation"]:
+        # Geometry of members in out geom output
+        children = [dict((key, value) for key, value in member.items() if key not in ("geometry", "lat", "lon"))
+                    for member in children]
+    if "lat" in attribs:
+        attribs["lat"] = float(attribs["lat"])
+        attribs["lon"] = float(attribs["lon"])
+    if strings is not None:
+        intern = strings.intern
+        if "user" in attribs:
+            attribs["user"] = intern(attribs["user"])
+        tags = dict((intern(key), intern(value)) for key, value in tags.items())
+        if cls is wrappers["relation"]:
+            for member in children:
+                if "role" in member:
+                    member["role"] = intern(member["role"])
+    if cls is wrappers["node"]:
+        return cls(attribs, tags)
+    return cls(attribs, tags, children)
+
+
+
+############################################################
+### Local storage.                                       ###
+############################################################
+
+class OSMStore(object):
+    """
+    Persistent store of Node, Way, Relation wrappers in dbm file.
+
+    Elements are stored one by one, so single changes can be applied without
+    loading the whole data set. Wrappers returned by the store are copies,
+    modified wrappers have to be added back.
+
+    Methods:
+        node        --- Retrieve Node wrapper by id or None.
+        way         --- Retrieve Way wrapper by id or None.
+        relation    --- Retrieve Relation wrapper by id or None.
+        add         --- Store wrapper, replacing the one with the same id.
+        discard     --- Remove wrapper with the same id.
+        update      --- Store all wrappers from iterable.
+        load        --- Store all wrappers from OSM XML file.
+        apply       --- Apply changes from OSC.
+        to_osm      --- Get OSM wrapper with all stored elements.
+        sync        --- Write cached changes to disk.
+        close       --- Close the store.
+
+    """
+
+    def __init__(self, filename, flag="c"):
+        """
+        Arguments:
+            filename    --- Filename of the dbm database.
+
+        Keyworded arguments:
+            flag        --- Mode of opening the database, see shelve.open.
+
+        """
+        self._shelf = shelve.open(filename, flag, protocol=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._shelf)
+
+    def __iter__(self):
+        for key in self._shelf.keys():
+            yield self._shelf[key]
+
+    def __contains__(self, item):
+        if not isinstance(item, (Node, Way, Relation)):
+            raise NotImplementedError
+        return self._key(item.xml_tag, item.id) in self._shelf
+
+    def _key(self, type_, id_):
+        return "{}/{}".format(type_, id_)
+
+    def _get(self, type_, id_):
+        return self._shelf.get(self._key(type_, id_))
+
+    def node(self, id_):
+        """
+        Retrieve Node wrapper by id or None.
+
+        Arguments:
+            id_     --- Id of the Node wrapper.
+
+        """
+        return self._get("node", id_)
+
+    def way(self, id_):
+        """
+        Retrieve Way wrapper by id or None.
+
+        Arguments:
+            id_     --- Id of the Way wrapper.
+
+        """
+        return self._get("way", id_)
+
+    def relation(self, id_):
+        """
+        Retrieve Relation wrapper by id or None.
+
+        Arguments:
+            id_     --- Id of the Relation wrapper.
+
+        """
+        return self._get("relation", id_)
+
+    def add(self, item):
+        """
+        Store wrapper, replacing the one with the same id.
+
+        Arguments:
+            item    --- Node, Way or Relation wrapper.
+
+        """
+        if not isinstance(item, (Node, Way, Relation)):
+            raise ValueError("Only Node, Way, Relation instances are allowed.")
+        self._shelf[self._key(item.xml_tag, item.id)] = item
+
+    def discard(self, item):
+        """
+        Remove wrapper with the same id.
+
+        Arguments:
+            item    --- Node, Way or Relation wrapper.
+
+        """
+        if not isinstance(item, (Node, Way, Relation)):
+            raise ValueError("Only Node, Way, Relation instances are allowed.")
+        self._shelf.pop(self._key(item.xml_tag, item.id), None)
+
+    def update(self, items):
+        """
+        Store all wrappers from iterable.
+
+        Arguments:
+            items   --- Iterable of wrappers, e.g. OSM or OSM.iterparse(filename).
+
+        """
+        for item in items:
+            self.add(item)
+
+    def load(self, filename, processes=None):
+        """
+        Store all wrappers from OSM XML file.
+
+        With processes, the workers also pickle the wrappers, so they are
+        written to the database without being created in this process.
+
+        Arguments:
+            filename    --- Filename of OSM XML file.
+
+        Keyworded arguments:
+            processes   --- Number of worker processes parsing the file split
+                            into byte ranges, None parses in this process.
+
+        """
+        if processes is None or processes <= 1:
+            self.update(OSM.iterparse(filename))
+            return
+        database = self._shelf.dict
+        encoding = getattr(self._shelf, "keyencoding", None)
+        for records in _parallel_map(_parse_records, filename, processes):
+            for type_, id_, data in records:
+                key = self._key(type_, id_)
+                if encoding is not None:
+                    key = key.encode(encoding)
+                database[key] = data
+
+    def apply(self, osc):
+        """
+        Apply changes from OSC.
+
+        Works like OSM.apply, only the changed elements are read and written.
+
+        Return number of applied changes.
+
+        Arguments:
+            osc     --- OSC instance or iterable of (action, element) tuples,
+                        e.g. OSC.iterparse(filename).
+
+        """
+        if isinstance(osc, OSC):
+            osc = osc.actions()
+        return _apply_actions(self, osc)
+
+    def to_osm(self):
+        """ Get OSM wrapper with all stored elements. """
+        return wrappers["osm"](self)
+
+    def sync(self):
+        """ Write cached changes to disk. """
+        self._shelf.sync()
+
+    def close(self):
+        """ Close the store. """
+        self._shelf.close()
+
+
+
+############################################################
+### Replication.                                         ###
+############################################################
+
+class ReplicationFollower(object):
+    """
+    Follower of replication diffs mirrored in local directory.
+
+    The directory has the layout of replication servers, state.txt with the
+    latest sequence number and diffs in NNN/NNN/NNN.osc.gz files. Progress
+    is kept in checkpoint file, so following can be resumed at any time.
+
+    Attributes:
+        directory   --- Directory with replication diffs.
+        checkpoint  --- Filename of checkpoint file.
+        sequence    --- Sequence number of the last applied diff.
+
+    Methods:
+        latest      --- Get sequence number of the latest available diff.
+        filename    --- Get filename of diff with sequence number.
+        actions     --- Iterate over (action, element) tuples of diff.
+        load        --- Load diff as OSC.
+        merge       --- Merge diffs into one OSC keeping the latest versions.
+        follow      --- Apply pending diffs to OSM or OSMStore.
+
+    """
+
+    log = logging.getLogger("osmapis.replication")
+
+    def __init__(self, directory, checkpoint, sequence=None):
+        """
+        Arguments:
+            directory   --- Directory with replication diffs.
+            checkpoint  --- Filename of checkpoint file.
+
+        Keyworded arguments:
+            sequence    --- Sequence number of the last applied diff, used
+                            when the checkpoint file doesn't exist yet.
+
+        """
+        self.directory = directory
+        self.checkpoint = checkpoint
+        if os.path.exists(checkpoint):
+            sequence = int(self._read_state(checkpoint)["sequenceNumber"])
+        elif sequence is None:
+            raise ValueError("Missing checkpoint file {!r}, starting sequence must be specified.".format(checkpoint))
+        self.sequence = int(sequence)
+
+    @staticmethod
+    def _read_state(filename):
+        state = {}
+        with open(filename) as fp:
+            for line in fp:
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                state[key.strip()] = value.strip().replace("\\", "")
+        return state
+
+    def _write_checkpoint(self, sequence):
+        state = {"sequenceNumber": str(sequence)}
+        filename = self.filename(sequence)[:-len(".osc.gz")] + ".state.txt"
+        if os.path.exists(filename):
+            state.update((key, value) for key, value in self._read_state(filename).items() if key == "timestamp")
+        temp = self.checkpoint + ".tmp"
+        with open(temp, "w") as fp:
+            for key in sorted(state):
+                fp.write("{}={}\n".format(key, state[key].replace(":", "\\:")))
+        if os.path.exists(self.checkpoint) and not hasattr(os, "replace"):
+            os.remove(self.checkpoint)
+        getattr(os, "replace", os.rename)(temp, self.checkpoint)
+        self.sequence = sequence
+
+    def latest(self):
+        """ Get sequence number of the latest available diff. """
+        return int(self._read_state(os.path.join(self.directory, "state.txt"))["sequenceNumber"])
+
+    def filename(self, sequence):
+        """
+        Get filename of diff with sequence number.
+
+        Arguments:
+            sequence    --- Sequence number of the diff.
+
+        """
+        path = "{:09d}".format(sequence)
+        return os.path.join(self.directory, path[0:3], path[3:6], path[6:9] + ".osc.gz")
+
+    def actions(self, sequence):
+        """
+        Iterate over (action, element) tuples of diff.
+
+        The diff is decompressed and parsed incrementally.
+
+        Arguments:
+            sequence    --- Sequence number of the diff.
+
+        """
+        with gzip.open(self.filename(sequence), "rb") as fp:
+            for action, element in wrappers["osc"].iterparse(fp):
+                yield action, element
+
+    def load(self, sequence):
+        """
+        Load diff as OSC.
+
+        Arguments:
+            sequence    --- Sequence number of the diff.
+
+        """
+        with gzip.open(self.filename(sequence), "rb") as fp:
+            return wrappers["osc"].from_xml(fp.read())
+
+    def merge(self, sequences):
+        """
+        Merge diffs into one OSC keeping the latest versions.
+
+        Only the latest version of every element is kept with its action.
+
+        Arguments:
+            sequences   --- Iterable of sequence numbers.
+
+        """
+        latest = {}
+        for sequence in sequences:
+            for action, element in self.actions(sequence):
+                key = (element.xml_tag, element.id)
+                current = latest.get(key)
+                if current is None or None in (current[1].version, element.version) or element.version >= current[1].version:
+                    latest[key] = (action, element)
+        changes = {"create": [], "modify": [], "delete": []}
+        for action, element in latest.values():
+            changes[action].append(element)
+        return wrappers["osc"]._from_changes(changes["create"], changes["modify"], changes["delete"])
+
+    def follow(self, target, batch=1, stop=None):
+        """
+        Apply pending diffs to OSM or OSMStore.
+
+        Diffs are merged in batches and every batch is followed by update of
+        the checkpoint file. Changes not newer than the target data are
+        skipped, so repeating a batch after interruption is harmless.
+
+        Return number of applied diffs.
+
+        Arguments:
+            target      --- OSM or OSMStore instance (or anything with apply method).
+
+        Keyworded arguments:
+            batch       --- Number of diffs to merge and apply at once.
+            stop        --- Sequence number of the last diff to apply, the latest by default.
+
+        """
+        if stop is None:
+            stop = self.latest()
+        count = 0
+        while self.sequence < stop:
+            sequences = range(self.sequence + 1, min(self.sequence + batch, stop) + 1)
+            if len(sequences) == 1:
+                target.apply(self.actions(sequences[0]))
+            else:
+                target.apply(self.merge(sequences))
+            if hasattr(target, "sync"):
+                target.sync()
+            self._write_checkpoint(sequences[-1])
+            count += len(sequences)
+            self.log.info("Applied replication diffs up to {}.".format(self.sequence))
+        return count
+
+
+
+############################################################
+### Stand-in server.                                     ###
+############################################################
+
+class _StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        StandInServer.log.debug(format % args)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length > 0 else None
+        if body is not None and (self.headers.get("Content-Encoding") or "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        status, headers, data = self.server.standin.handle(self.command, self.path, body, self.headers)
+        if "gzip" in (self.headers.get("Accept-Encoding") or "") and len(data) > 0:
+            data = HTTPClient._compress(data)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+class StandInServer(object):
+    """
+    Local HTTP server emulating OSM API 0.6 and Overpass API over a local dataset.
+
+    Meant for reproducible benchmarks and tests of throughput, retries and
+    concurrency on an isolated machine. Supports capabilities, map, element,
+    elements, history, full, relations, ways, changeset and upload calls of
+    OSM API, and id-query, bbox-query, recurse, union and print statements
+    of Overpass XML queries, id, recurse and out statements of Overpass QL
+    queries, both with XML or JSON output.
+
+    Usage:
+        with StandInServer(osm, latency=0.05) as server:
+            api = API("user", "password")
+            api.server = server.address
+
+    Attributes:
+        osm         --- OSM wrapper with current data.
+        latency     --- Delay in seconds added to every response.
+        error_rate  --- Probability of responding with error_status.
+        error_status --- HTTP status of injected errors.
+        max_elements --- Maximum number of elements in changeset.
+        requests    --- Number of handled requests.
+        address     --- 'host:port' of running server, read-only.
+
+    Methods:
+        start       --- Start serving requests in background thread.
+        stop        --- Stop the server.
+        fail_next   --- Respond to the next requests with error.
+        handle      --- Handle request and return (status, headers, body).
+
+    """
+
+    log = logging.getLogger("osmapis.standin")
+
+    def __init__(self, osm=None, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, error_status=503, max_elements=10000, seed=None):
+        """
+        Keyworded arguments:
+            osm         --- OSM wrapper with initial data, it's copied.
+            host        --- Address to listen on.
+            port        --- Port to listen on, 0 picks free port.
+            latency     --- Delay in seconds added to every response.
+            error_rate  --- Probability of responding with error_status.
+            error_status --- HTTP status of injected errors.
+            max_elements --- Maximum number of elements in changeset.
+            seed        --- Seed of random generator used for error injection.
+
+        """
+        if osm is None:
+            osm = wrappers["osm"]()
+        self.osm = wrappers["osm"].from_xml(ET.tostring(osm.to_xml(), encoding="utf-8"))
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.error_status = int(error_status)
+        self.max_elements = int(max_elements)
+        self.requests = 0
+        self.changesets = {}
+        self._deleted = {"node": {}, "way": {}, "relation": {}}
+        self._last_id = {"node": 0, "way": 0, "relation": 0, "changeset": 0}
+        for element in self.osm:
+            self._last_id[element.xml_tag] = max(self._last_id[element.xml_tag], element.id)
+        self._failures = []
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._host = host
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        """ 'host:port' of running server """
+        if self._server is None:
+            return None
+        return "{}:{}".format(*self._server.server_address[:2])
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """ Start serving requests in background thread. """
+        self._server = _StandInHTTPServer((self._host, self._port), _StandInHandler)
+        self._server.standin = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the server. """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def fail_next(self, count=1, status=None):
+        """
+        Respond to the next requests with error.
+
+        Keyworded arguments:
+            count       --- Number of requests to fail.
+            status      --- HTTP status of the error, error_status by default.
+
+        """
+        with self._lock:
+            self._failures.extend([status or self.error_status] * count)
+
+    def handle(self, method, path, body, headers):
+        """
+        Handle request and return (status, headers, body).
+
+        Arguments:
+            method      --- HTTP request method.
+            path        --- Requested path including query string.
+            body        --- Request body as bytes or None.
+            headers     --- Request headers.
+
+        """
+        if self.latency > 0:
+            sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if len(self._failures) > 0:
+                status = self._failures.pop(0)
+                return status, {"Content-Type": "text/plain"}, "Injected error.".encode("utf-8")
+            if self.error_rate > 0 and self._random.random() < self.error_rate:
+                return self.error_status, {"Content-Type": "text/plain"}, "Injected error.".encode("utf-8")
+            url = urlsplit(path)
+            try:
+                if url.path == "/api/interpreter":
+                    data = parse_qs(body.decode("utf-8"))["data"][0]
+                    content_type, result = self._interpreter(data)
+                    return 200, {"Content-Type": content_type}, result
+                if url.path == "/api/capabilities":
+                    return 200, {"Content-Type": "text/xml"}, self._capabilities()
+                prefix = "/api/{}/".format(API.version)
+                if not url.path.startswith(prefix):
+                    raise _StandInError(404, "Not found.")
+                parts = url.path[len(prefix):].strip("/").split("/")
+                query = dict((key, value[0]) for key, value in parse_qs(url.query).items())
+                if method != "GET" and "Authorization" not in headers:
+                    raise _StandInError(401, "Couldn't authenticate you")
+                result = self._api(method, parts, query, body)
+                if isinstance(result, ET.Element):
+                    result = ET.tostring(result, encoding="utf-8")
+                else:
+                    result = str(result).encode("utf-8")
+                return 200, {"Content-Type": "text/xml; charset=utf-8"}, result
+            except _StandInError as e:
+                return e.status, {"Content-Type": "text/plain"}, e.message.encode("utf-8")
+
+    ##################################################
+    # OSM API                                        #
+    ##################################################
+    def _capabilities(self):
+        root = ET.Element("osm", {"version": str(API.version), "generator": "osmapis"})
+        api = ET.SubElement(root, "api")
+        ET.SubElement(api, "version", {"minimum": str(API.version), "maximum": str(API.version)})
+        ET.SubElement(api, "area", {"maximum": "0.25"})
+        ET.SubElement(api, "waynodes", {"maximum": "2000"})
+        ET.SubElement(api, "changesets", {"maximum_elements": str(self.max_elements)})
+        ET.SubElement(api, "timeout", {"seconds": "300"})
+        return ET.tostring(root, encoding="utf-8")
+
+    def _api(self, method, parts, query, body):
+        types = ("node", "way", "relation")
+        if method == "GET" and parts == ["map"]:
+            left, bottom, right, top = [float(value) for value in query["bbox"].split(",")]
+            return self._document(self._map(left, bottom, right, top))
+        if method == "GET" and len(parts) == 1 and parts[0] in ("nodes", "ways", "relations"):
+            type_ = parts[0][:-1]
+            elements = []
+            for id_ in query.get(parts[0], "").split(","):
+                elements.append(self._get(type_, int(id_)))
+            return self._document(elements)
+        if parts[0] == "changeset":
+            return self._changeset(method, parts[1:], body)
+        if parts[0] not in types or len(parts) < 2:
+            raise _StandInError(404, "Not found.")
+        type_ = parts[0]
+        if parts[1] == "create" and method == "PUT":
+            element = self._parse_payload(type_, body)
+            result = self._commit(self._changeset_id(element), [("create", element)])
+            return result[0][2]
+        id_ = int(parts[1])
+        if len(parts) == 2 and method == "PUT":
+            element = self._parse_payload(type_, body)
+            result = self._commit(self._changeset_id(element), [("modify", element)])
+            return result[0][3]
+        if len(parts) == 2 and method == "DELETE":
+            element = self._parse_payload(type_, body)
+            result = self._commit(self._changeset_id(element), [("delete", element)])
+            return result[0][3]
+        if method != "GET":
+            raise _StandInError(405, "Method not allowed.")
+        if len(parts) == 2:
+            return self._document([self._get(type_, id_)])
+        if parts[2] == "history":
+            element = self._get(type_, id_, deleted=True)
+            return self._document(element.history[version] for version in sorted(element.history))
+        if parts[2].isdigit():
+            element = self._get(type_, id_, deleted=True)
+            if int(parts[2]) not in element.history:
+                raise _StandInError(404, "Not found.")
+            return self._document([element.history[int(parts[2])]])
+        if parts[2] == "full" and type_ in ("way", "relation"):
+            element = self._get(type_, id_)
+            return self._document(self._full(element))
+        if parts[2] == "relations":
+            return self._document(self._relations(set([(type_, id_)])))
+        if parts[2] == "ways" and type_ == "node":
+            return self._document(self._ways(set([id_])))
+        raise _StandInError(404, "Not found.")
+
+    def _document(self, elements):
+        root = ET.Element("osm", {"version": str(API.version), "generator": "osmapis stand-in"})
+        for element in elements:
+            root.append(element.to_xml())
+        return root
+
+    def _container(self, type_):
+        return getattr(self.osm, type_ + "s")
+
+    def _get(self, type_, id_, deleted=False):
+        element = self._container(type_).get(id_)
+        if element is None:
+            element = self._deleted[type_].get(id_)
+            if element is None:
+                raise _StandInError(404, "Not found.")
+            if not deleted:
+                raise _StandInError(410, "Gone.")
+        return element
+
+    def _map(self, left, bottom, right, top):
+        nodes = set()
+        for node in self.osm.nodes.values():
+            if bottom <= node.lat <= top and left <= node.lon <= right:
+                nodes.add(node.id)
+        ways = self._ways(nodes)
+        for way in ways:
+            nodes.update(way.nds)
+        keys = set(("node", id_) for id_ in nodes) | set(("way", way.id) for way in ways)
+        relations = self._relations(keys)
+        result = [self.osm.nodes[id_] for id_ in sorted(nodes) if id_ in self.osm.nodes]
+        return result + ways + relations
+
+    def _ways(self, nodes):
+        return [way for way in self.osm.ways.values() if not nodes.isdisjoint(way.nds)]
+
+    def _relations(self, keys):
+        result = []
+        for relation in self.osm.relations.values():
+            for member in relation.members:
+                if (member["type"], member["ref"]) in keys:
+                    result.append(relation)
+                    break
+        return result
+
+    def _full(self, element):
+        result = [element]
+        if element.xml_tag == "relation":
+            for member in element.members:
+                member = self._container(member["type"]).get(member["ref"])
+                if member is not None:
+                    result.append(member)
+        nodes = []
+        for way in result:
+            if way.xml_tag == "way":
+                nodes.extend(self.osm.nodes[id_] for id_ in way.nds if id_ in self.osm.nodes)
+        return nodes + result
+
+    ##################################################
+    # Changesets and uploads                         #
+    ##################################################
+    def _changeset(self, method, parts, body):
+        if method == "PUT" and parts == ["create"]:
+            changeset = wrappers["changeset"].from_xml(ET.XML(body).find("changeset"))
+            self._last_id["changeset"] += 1
+            changeset.attribs["id"] = self._last_id["changeset"]
+            changeset.attribs["open"] = True
+            changeset.count = 0
+            changeset.osc = wrappers["osc"]()
+            self.changesets[changeset.id] = changeset
+            return changeset.id
+        if len(parts) == 0 or not parts[0].isdigit():
+            raise _StandInError(404, "Not found.")
+        changeset = self.changesets.get(int(parts[0]))
+        if changeset is None:
+            raise _StandInError(404, "Not found.")
+        if method == "GET" and len(parts) == 1:
+            return self._changeset_document(changeset)
+        if method == "GET" and parts[1:] == ["download"]:
+            return changeset.osc.to_xml()
+        if not changeset.attribs["open"]:
+            raise _StandInError(409, "The changeset {} was closed.".format(changeset.id))
+        if method == "PUT" and len(parts) == 1:
+            changeset.tags = wrappers["changeset"].from_xml(ET.XML(body).find("changeset")).tags
+            return self._changeset_document(changeset)
+        if method == "PUT" and parts[1:] == ["close"]:
+            changeset.attribs["open"] = False
+            return ""
+        if method == "POST" and parts[1:] == ["upload"]:
+            actions = []
+            for section in ET.XML(body):
+                for element in section:
+                    actions.append((section.tag, wrappers[element.tag].from_xml(element)))
+            root = ET.Element("diffResult", {"version": str(API.version), "generator": "osmapis stand-in"})
+            for (action, element), (type_, old_id, new_id, new_version) in zip(actions, self._commit(changeset.id, actions)):
+                attribs = {"old_id": str(old_id)}
+                if action != "delete":
+                    attribs["new_id"] = str(new_id)
+                    attribs["new_version"] = str(new_version)
+                ET.SubElement(root, type_, attribs)
+            return root
+        raise _StandInError(404, "Not found.")
+
+    def _changeset_document(self, changeset):
+        root = ET.Element("osm", {"version": str(API.version), "generator": "osmapis stand-in"})
+        root.append(changeset.to_xml())
+        return root
+
+    def _changeset_id(self, element):
+        if element.attribs.get("changeset") is None:
+            raise _StandInError(400, "Missing changeset.")
+        return element.attribs["changeset"]
+
+    def _parse_payload(self, type_, body):
+        element = ET.XML(body).find(type_)
+        if element is None:
+            raise _StandInError(400, "Missing {}.".format(type_))
+        return wrappers[type_].from_xml(element)
+
+    def _commit(self, changeset_id, actions):
+        """ Apply list of (action, element) atomically and return list of (type, old_id, new_id, new_version). """
+        changeset = self.changesets.get(changeset_id)
+        if changeset is None or not changeset.attribs["open"]:
+            raise _StandInError(409, "The changeset {} is not open.".format(changeset_id))
+        if changeset.count + len(actions) > self.max_elements:
+            raise _StandInError(409, "The changeset {} has exceeded its limit of {} elements.".format(changeset_id, self.max_elements))
+        placeholders = {"node": {}, "way": {}, "relation": {}}
+        pending = {}
+        last_id = dict(self._last_id)
+        result = []
+        def current(type_, id_):
+            if (type_, id_) in pending:
+                return pending[(type_, id_)]
+            return self._container(type_).get(id_)
+        for action, element in actions:
+            type_ = element.xml_tag
+            old_id = element.id
+            id_ = placeholders[type_].get(old_id, old_id)
+            if type_ == "way":
+                element.nds = [placeholders["node"].get(ref, ref) for ref in element.nds]
+                refs = [("node", ref) for ref in element.nds]
+            elif type_ == "relation":
+                for member in element.members:
+                    member["ref"] = placeholders[member["type"]].get(member["ref"], member["ref"])
+                refs = [(member["type"], member["ref"]) for member in element.members]
+            else:
+                refs = []
+            if action != "delete":
+                for ref_type, ref in refs:
+                    target = current(ref_type, ref)
+                    if target is None or not target.attribs.get("visible", True):
+                        raise _StandInError(412, "{} {} requires the {} with id {}, which either does not exist, or is not visible.".format(type_.capitalize(), old_id, ref_type, ref))
+            if action == "create":
+                last_id[type_] += 1
+                id_ = last_id[type_]
+                placeholders[type_][old_id] = id_
+                version = 1
+            else:
+                existing = current(type_, id_)
+                if existing is None:
+                    raise _StandInError(404, "The {} with the id {} was not found.".format(type_, id_))
+                if existing.version != element.version:
+                    raise _StandInError(409, "Version mismatch: Provided {}, server had: {} of {} {}".format(element.version, existing.version, type_.capitalize(), id_))
+                version = existing.version + 1
+            element.attribs.update({"id": id_, "version": version, "changeset": changeset_id, "visible": action != "delete"})
+            previous = current(type_, id_)
+            element.history = dict(previous.history) if previous is not None else {}
+            element.history[version] = element
+            pending[(type_, id_)] = element
+            result.append((type_, old_id, id_, version))
+        self._last_id = last_id
+        for (type_, id_), element in pending.items():
+            for version in element.history.values():
+                version.history = element.history
+            if element.attribs["visible"]:
+                self._container(type_)[id_] = element
+                self._deleted[type_].pop(id_, None)
+            else:
+                self._container(type_).pop(id_, None)
+                self._deleted[type_][id_] = element
+        for (action, element) in actions:
+            getattr(changeset.osc, action)(element)
+        changeset.count += len(actions)
+        return result
+
+    ##################################################
+    # Overpass API                                   #
+    ##################################################
+    def _interpreter(self, query):
+        if not query.lstrip().startswith("<"):
+            return self._ql(query)
+        if not query.lstrip().startswith("<osm-script"):
+            query = "<osm-script>{}</osm-script>".format(query)
+        sets = {"_": set()}
+        root = ET.Element("osm", {"version": str(API.version), "generator": "osmapis stand-in"})
+        script = ET.XML(query)
+        for statement in script:
+            self._statement(statement, sets, root)
+        if script.attrib.get("output") == "json":
+            return "application/json", self._json(root)
+        return "application/osm3s+xml", ET.tostring(root, encoding="utf-8")
+
+    def _json(self, root):
+        items = []
+        for child in root:
+            element = wrappers[child.tag].from_xml(child)
+            item = OrderedDict([("type", child.tag)])
+            item.update(element.attribs)
+            if child.tag == "way":
+                item["nodes"] = list(element.nds)
+            elif child.tag == "relation":
+                item["members"] = [dict(member) for member in element.members]
+            if len(element.tags) > 0:
+                item["tags"] = dict(element.tags)
+            items.append(item)
+        data = OrderedDict([("version", API.version), ("generator", "osmapis stand-in"), ("elements", items)])
+        return json.dumps(data, indent=1).encode("utf-8")
+
+    def _ql(self, query):
+        sets = {"_": set()}
+        root = ET.Element("osm", {"version": str(API.version), "generator": "osmapis stand-in"})
+        output = "xml"
+        statements = self._ql_split(query)
+        if len(statements) > 0 and statements[0].startswith("["):
+            if "[out:json]" in statements[0]:
+                output = "json"
+            statements.pop(0)
+        for statement in statements:
+            self._ql_statement(statement, sets, root)
+        if output == "json":
+            return "application/json", self._json(root)
+        return "application/osm3s+xml", ET.tostring(root, encoding="utf-8")
+
+    def _ql_split(self, text):
+        statements = []
+        depth = 0
+        start = 0
+        for i, char in enumerate(text):
+            if char in "([":
+                depth += 1
+            elif char in ")]":
+                depth -= 1
+            elif char == ";" and depth == 0:
+                statements.append(text[start:i].strip())
+                start = i + 1
+        statements.append(text[start:].strip())
+        return [statement for statement in statements if statement != ""]
+
+    def _ql_statement(self, statement, sets, output):
+        match = re.match(r"(node|way|rel)\((.*)\)$", statement, re.S)
+        if statement.startswith("(") and statement.endswith(")"):
+            result = set()
+            for child in self._ql_split(statement[1:-1]):
+                self._ql_statement(child, sets, output)
+                result |= sets["_"]
+            sets["_"] = result
+        elif match is not None:
+            type_ = "relation" if match.group(1) == "rel" else match.group(1)
+            filter_ = match.group(2).replace(" ", "")
+            recurse = dict((value, key) for key, value in _ql_recurse.items())
+            if filter_.startswith("id:"):
+                ids = set(int(id_) for id_ in filter_[3:].split(","))
+                sets["_"] = set((type_, id_) for id_ in ids if id_ in self._container(type_))
+            elif "{}({})".format(match.group(1), filter_) in recurse:
+                sets["_"] = self._recurse(recurse["{}({})".format(match.group(1), filter_)], sets["_"])
+            elif type_ == "node" and filter_.count(",") == 3:
+                south, west, north, east = filter_.split(",")
+                self._statement(ET.Element("bbox-query", {"w": west, "s": south, "e": east, "n": north}), sets, output)
+            else:
+                raise _StandInError(400, "Unsupported filter {}.".format(statement))
+        elif statement.split()[0] == "out":
+            mode = "meta" if "meta" in statement.split() else "body"
+            self._statement(ET.Element("print", {"mode": mode}), sets, output)
+        else:
+            raise _StandInError(400, "Unsupported statement {}.".format(statement))
+
+    def _statement(self, statement, sets, output):
+        tag = statement.tag
+        attribs = statement.attrib
+        into = attribs.get("into", "_")
+        if tag == "union":
+            result = set()
+            for child in statement:
+                self._statement(child, sets, output)
+                result |= sets[child.attrib.get("into", "_")]
+            sets[into] = result
+        elif tag == "id-query":
+            type_ = attribs["type"]
+            id_ = int(attribs["ref"])
+            sets[into] = set([(type_, id_)]) if id_ in self._container(type_) else set()
+        elif tag == "bbox-query":
+            west, south, east, north = [float(attribs[key]) for key in ("w", "s", "e", "n")]
+            sets[into] = set(("node", node.id) for node in self.osm.nodes.values() if south <= node.lat <= north and west <= node.lon <= east)
+        elif tag == "recurse":
+            sets[into] = self._recurse(attribs["type"], sets.get(attribs.get("from", "_"), set()))
+        elif tag == "print":
+            keys = sets.get(attribs.get("from", "_"), set())
+            strip = () if attribs.get("mode") == "meta" else ("version", "changeset", "timestamp", "user", "uid")
+            for type_ in ("node", "way", "relation"):
+                container = self._container(type_)
+                for id_ in sorted(id_ for key_type, id_ in keys if key_type == type_):
+                    output.append(container[id_].to_xml(strip=strip))
+        else:
+            raise _StandInError(400, "Unsupported statement {}.".format(tag))
+
+    def _recurse(self, type_, keys):
+        source, target = type_.split("-", 1)
+        ids = set(id_ for key_type, id_ in keys if key_type == source)
+        if type_ == "way-node":
+            return set(("node", ref) for id_ in ids for ref in self.osm.ways[id_].nds)
+        if type_ in ("relation-node", "relation-way", "relation-relation"):
+            return set((target, member["ref"]) for id_ in ids for member in self.osm.relations[id_].members if member["type"] == target and member["ref"] in self._container(target))
+        if type_ == "node-way":
+            return set(("way", way.id) for way in self._ways(ids))
+        if type_ in ("node-relation", "way-relation"):
+            return set(("relation", relation.id) for relation in self._relations(set((source, id_) for id_ in ids)))
+        if type_ == "relation-backwards":
+            return set(("relation", relation.id) for relation in self._relations(set(("relation", id_) for id_ in ids)))
+        raise _StandInError(400, "Unsupported recurse type {}.".format(type_))
+
+
+class _StandInError(Exception):
+    """ Error response of stand-in server. """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
 
 
 ############################################################
@@ -2335,9 +6894,13 @@ class APIError(Exception):
     Attributes:
         reason      --- The reason of failure.
         payload     --- Data sent to API with request.
+        partial_result --- Result of already committed chunks of failed
+                        chunked upload_diff, otherwise None.
 
     """
 
+    partial_result = None
+
     def __init__(self, reason, payload, http_reason=None, http_status=None):
         """
         Arguments: